@@ -0,0 +1,95 @@
+"""Benchmarks whole RouterCollector.collect() cycles of simulated fleets,
+every router replays a fixture instead of connecting anywhere
+
+Run from the repository root:
+    python -m benchmarks.collect [--sizes 1 10 50] [--latency 0.005]
+Recorded fixtures (see the record transport option) can be replayed
+with --fixture PATH --backend BACKEND"""
+import io
+import os
+import tempfile
+import contextlib
+from functools import partial
+
+from router_prometheus import fleet, main, poller, transport
+
+from . import corpora, harness
+
+
+def add_arguments(parser):
+    parser.add_argument("--stations", type=int, default=20,
+                        help="stations per router in the generated fixture")
+    parser.add_argument("--backend", default="openwrt",
+                        choices=sorted(corpora.fixtures),
+                        help="backend of the routers")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds every replayed command takes")
+    parser.add_argument("--batch", action="store_true",
+                        help="run every update as a single batch script")
+    parser.add_argument("--fixture", metavar="PATH",
+                        help="replay a recorded fixture of a --backend "
+                        "router instead of a generated one")
+
+
+def fleet_config(size, fixture, backend, latency, batch):
+    """routers.yml of a fleet where every router replays the same fixture"""
+    return {"router" + str(index): {"address": fixture,
+                                    "backend": backend,
+                                    "batch": batch,
+                                    "transport": {"username": "root",
+                                                  "engine": "replay",
+                                                  "latency": latency}}
+            for index in range(size)}
+
+
+def build_collector(routers_config, workers):
+    """Initializes all routers right away and returns a collector
+    that refreshes them on every collect()"""
+    router_fleet = fleet.Fleet(routers_config, {}, workers)
+    collector = main.RouterCollector(poller.Poller(router_fleet, workers))
+    # The first collect() learns the parser line numbers, the benchmark
+    # measures the steady state
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in routers_config:
+            router_fleet.initialize(name)
+        collect(collector)
+    if len(router_fleet.routers) != len(routers_config):
+        raise RuntimeError("Some routers failed to initialize")
+    return collector
+
+
+def collect(collector):
+    return list(collector.collect())
+
+
+def cases(args):
+    fixture = args.fixture
+    if fixture is None:
+        fixture = os.path.join(tempfile.mkdtemp(), args.backend + ".json")
+        transport.save_fixture(fixture, corpora.fixtures[args.backend](
+            args.stations))
+    for size in args.sizes:
+        routers_config = fleet_config(size, fixture, args.backend,
+                                      args.latency, args.batch)
+        # workers=0 starts one worker per router
+        for name, workers in [("collect sequential", 1),
+                              ("collect parallel", 0)]:
+            collector = build_collector(routers_config, workers)
+            yield harness.Case(name, size, partial(collect, collector))
+
+
+def print_speedups(results):
+    """Shows how much updating the routers in parallel gains"""
+    sequential = {result.size: result.seconds for result in results
+                  if result.name == "collect sequential"}
+    for result in results:
+        if result.name == "collect parallel" and \
+           result.size in sequential:
+            print("Parallel collection is %.1fx faster with %d routers"
+                  % (sequential[result.size] / result.seconds, result.size))
+
+
+if __name__ == "__main__":
+    print_speedups(harness.main("Full collection cycle benchmarks", cases,
+                                [1, 10, 50], "numbers of routers in the "
+                                "simulated fleet", add_arguments))
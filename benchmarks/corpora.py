@@ -0,0 +1,224 @@
+import os
+import json
+
+from router_prometheus import router
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(__file__), "corpus")
+
+
+def load(name: str) -> str:
+    """Returns the contents of a file from the corpus directory"""
+    with open(os.path.join(CORPUS_DIRECTORY, name), "r",
+              encoding="utf-8") as corpus_file:
+        return corpus_file.read()
+
+
+def mac(index: int) -> str:
+    return "02:00:%02x:%02x:%02x:%02x" % (index >> 24 & 0xff,
+                                          index >> 16 & 0xff,
+                                          index >> 8 & 0xff, index & 0xff)
+
+
+def station_fields(index: int) -> dict:
+    """Deterministic per-station values, so that every run
+    parses exactly the same text"""
+    return {"mac": mac(index),
+            "signal": -30 - index % 60,
+            "signal2": -32 - index % 60,
+            "inactive": index * 37 % 5000,
+            "rx_bytes": 1000000 + index * 7919,
+            "rx_packets": 10000 + index * 31,
+            "tx_bytes": 2000000 + index * 104729,
+            "tx_packets": 20000 + index * 17,
+            "tx_retries": index % 11,
+            "connected": 60 + index * 13,
+            "boottime": 100000 + index}
+
+
+def iw_station_dump(stations: int, interface: str = "wlan0",
+                    first: int = 0) -> str:
+    """Output of iw dev INT station dump with the given number of stations,
+    first is the index of the first station"""
+    template = load("iw_station_dump.txt")
+    return "".join(template.format(interface=interface,
+                                   **station_fields(index))
+                   for index in range(first, first + stations))
+
+
+def ate_show_stainfo(stations: int) -> str:
+    """Output of the DSL-AC55U's ATE show_stainfo,
+    the stations are split between the 2.4 GHz and 5 GHz radios"""
+    template = load("ate_show_stainfo.txt")
+    station = load("ate_station.txt")
+    lines = [station.format(**station_fields(index)).rstrip("\n")
+             for index in range(stations)]
+    half = (stations + 1) // 2
+    return template.format(stations_2g="\n".join(lines[:half]),
+                           stations_5g="\n".join(lines[half:]))
+
+
+def wl_rssi(stations: int, first: int = 0) -> str:
+    """Output of DdwrtRouter.rssi_command()"""
+    template = load("wl_rssi.txt")
+    return "".join(template.format(**station_fields(index))
+                   for index in range(first, first + stations))
+
+
+def iw_info(index: int, interface: str) -> str:
+    """Output of iw INT info, odd interfaces are on 5 GHz"""
+    if index % 2:
+        channel, frequency = 36, 5180
+    else:
+        channel, frequency = 6, 2437
+    return load("iw_info.txt").format(interface=interface,
+                                      ifindex=10 + index, wdev=index + 1,
+                                      ssid="Network-" + str(index),
+                                      wiphy=index, channel=channel,
+                                      frequency=frequency,
+                                      center=frequency + 30)
+
+
+def parser_router(router_class):
+    """Returns a backend object that can only be used for parsing
+    and building commands, the constructor (which connects to the router)
+    and the destructor are skipped"""
+    parser_class = type(router_class.__name__, (router_class,),
+                        {"__del__": lambda self: None})
+    rtr = parser_class.__new__(parser_class)
+    rtr.name = "benchmark"
+    return rtr
+
+
+def split_stations(stations: int, interfaces: list) -> list:
+    """Splits the stations between interfaces,
+    returns the first station index and count of every interface"""
+    shares = []
+    first = 0
+    for index in range(len(interfaces)):
+        share = stations // len(interfaces) + \
+            (index < stations % len(interfaces))
+        shares.append((first, share))
+        first += share
+    return shares
+
+
+def interfaces_output(wired: list, wireless: list) -> str:
+    """Output of router.INTERFACES_COMMAND"""
+    return "".join(interface + " 0\n" for interface in wired) + \
+        "".join(interface + " 1\n" for interface in wireless)
+
+
+def net_dev(interfaces: list) -> str:
+    """Output of cat /proc/net/dev"""
+    lines = ["Inter-|   Receive                            "
+             "                    |  Transmit",
+             " face |bytes    packets errs drop fifo frame compressed "
+             "multicast|bytes    packets errs drop fifo colls carrier "
+             "compressed"]
+    for index, interface in enumerate(interfaces):
+        lines.append("%6s: %d %d %d %d 0 0 0 0 %d %d %d %d 0 0 0 0"
+                     % (interface, 10 ** 9 * (index + 1),
+                        10 ** 6 * (index + 1), index, index * 3,
+                        2 * 10 ** 9 * (index + 1), 2 * 10 ** 6 * (index + 1),
+                        index, index * 2))
+    return "\n".join(lines) + "\n"
+
+
+def fixture(outputs: dict) -> dict:
+    """Turns a dict of command -> output or (output, exit code)
+    into the commands of a replay fixture"""
+    commands = {}
+    for command, output in outputs.items():
+        if isinstance(output, str):
+            output = (output, 0)
+        commands[command] = [{"stdout": output[0], "exited": output[1],
+                              "seconds": 0.0}]
+    return commands
+
+
+def openwrt_fixture(stations: int, interfaces: int = 2) -> dict:
+    """Replay fixture of an OpenWrt router, the stations are split
+    between the wireless interfaces"""
+    wireless = ["wlan" + str(index) for index in range(interfaces)]
+    wired = ["br-lan", "eth0", "lo"]
+    outputs = {"echo": "\n",
+               router.INTERFACES_COMMAND: interfaces_output(wired, wireless),
+               "ls /sys/class/net": "\n".join(wired + wireless) + "\n",
+               "cat /proc/loadavg": load("loadavg.txt"),
+               "cat /proc/meminfo": load("meminfo.txt")}
+    for index, (interface, (first, share)) in enumerate(
+            zip(wireless, split_stations(stations, wireless))):
+        outputs["iw " + interface + " info"] = iw_info(index, interface)
+        outputs["iw dev " + interface + " station dump"] = \
+            iw_station_dump(share, interface, first)
+    outputs["cat /proc/net/dev"] = net_dev(["lo", "eth0", "br-lan"]
+                                           + wireless)
+    return fixture(outputs)
+
+
+def ddwrt_fixture(stations: int, interfaces: int = 2) -> dict:
+    """Replay fixture of a Broadcom DD-WRT router"""
+    rtr = parser_router(router.DdwrtRouter)
+    rtr.wl_command = "wl"
+    wireless = ["eth" + str(index + 1) for index in range(interfaces)]
+    wired = ["br0", "eth0", "lo", "vlan1", "vlan2"]
+    outputs = {"echo": "\n",
+               router.INTERFACES_COMMAND: interfaces_output(wired, wireless),
+               "cat /proc/loadavg": load("loadavg.txt"),
+               "cat /proc/meminfo": load("meminfo.txt"),
+               "which wl": "/usr/sbin/wl\n",
+               "which wl_atheros": ("", 1),
+               "test -f /proc/dmu/temperature": "",
+               "cat /proc/dmu/temperature": "452\n"}
+    for index, (interface, (first, share)) in enumerate(
+            zip(wireless, split_stations(stations, wireless))):
+        channel = 36 if index % 2 else 6
+        outputs[rtr.wl(interface, "phy_tempsense")] = "52 (0x34)\n"
+        outputs[rtr.rssi_command(interface)] = wl_rssi(share, first)
+        outputs[rtr.wl(interface, "radio")] = "0x0000\n"
+        outputs[rtr.wl(interface, "channel")] = (
+            "current mac channel\t" + str(channel) + "\n"
+            "target channel\t" + str(channel) + "\n")
+        outputs[rtr.wl(interface, "ssid")] = \
+            'Current SSID: "Network-' + str(index) + '"\n'
+    outputs["cat /proc/net/dev"] = net_dev(["lo", "eth0", "vlan1", "vlan2",
+                                            "br0"] + wireless)
+    return fixture(outputs)
+
+
+def ubnt_fixture(stations: int, interfaces: int = 1) -> dict:
+    """Replay fixture of a Ubiquiti bridge, which only has one radio"""
+    wstalist = [{"mac": station_fields(index)["mac"],
+                 "signal": station_fields(index)["signal"],
+                 "rssi": 96 + station_fields(index)["signal"],
+                 "tx": 300, "rx": 270}
+                for index in range(stations)]
+    outputs = {"echo": "\n",
+               router.INTERFACES_COMMAND: interfaces_output(
+                   ["br0", "eth0", "lo"], ["ath0", "wifi0"]),
+               "cat /proc/loadavg": load("loadavg.txt"),
+               "cat /proc/meminfo": load("meminfo.txt"),
+               "wstalist": json.dumps(wstalist) + "\n",
+               "iwgetid -c ath0": "ath0      Channel:36\n"}
+    outputs["cat /proc/net/dev"] = net_dev(["lo", "eth0", "br0", "wifi0",
+                                            "ath0"])
+    return fixture(outputs)
+
+
+def dsl_fixture(stations: int, interfaces: int = 2) -> dict:
+    """Replay fixture of an Asus DSL-AC55U, the wireless interfaces
+    are hard-coded in the backend"""
+    outputs = {"echo": "\n",
+               "cat /proc/loadavg": load("loadavg.txt"),
+               "cat /proc/meminfo": load("meminfo.txt"),
+               "ATE show_stainfo": ate_show_stainfo(stations)}
+    outputs["cat /proc/net/dev"] = net_dev(["lo", "eth0", "br0", "ra0",
+                                            "rai0"])
+    return fixture(outputs)
+
+
+# Fixture generators by backend name, like router.backends
+fixtures = {"dd-wrt": ddwrt_fixture,
+            "openwrt": openwrt_fixture,
+            "ubnt": ubnt_fixture,
+            "dsl-ac55U": dsl_fixture}
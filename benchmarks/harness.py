@@ -0,0 +1,119 @@
+import gc
+import sys
+import json
+import timeit
+import argparse
+import tracemalloc
+
+from typing import Callable, Iterable, NamedTuple, Optional
+
+
+class Case(NamedTuple):
+    """A single function to benchmark, size is the number of stations
+    or routers it works with"""
+    name: str
+    size: int
+    function: Callable
+
+
+class Result(NamedTuple):
+    name: str
+    size: int
+    seconds: float
+    peak_bytes: int
+    kept_bytes: int
+
+    @property
+    def key(self) -> str:
+        return self.name + " " + str(self.size)
+
+
+def measure(case: Case, repeat: int = 5) -> Result:
+    """Runs a case until the timing is stable and returns the best time
+    of a single call, then runs it once more under tracemalloc
+    to see how much memory a single call allocates"""
+    timer = timeit.Timer(case.function)
+    loops, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat, loops)) / loops
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = case.function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return Result(case.name, case.size, seconds, peak - before,
+                  current - before)
+
+
+def print_results(results: list) -> None:
+    print("%-36s %8s %12s %12s %12s"
+          % ("benchmark", "size", "time/call", "peak KiB", "kept KiB"))
+    for result in results:
+        print("%-36s %8d %10.1fus %12.1f %12.1f"
+              % (result.name, result.size, result.seconds * 1e6,
+                 result.peak_bytes / 1024, result.kept_bytes / 1024))
+
+
+def save_results(results: list, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as results_file:
+        json.dump({result.key: result._asdict() for result in results},
+                  results_file, indent=2)
+
+
+def compare_results(results: list, path: str, threshold: float) -> list:
+    """Compares results with the ones saved in path
+    Returns the keys of benchmarks that got slower than threshold allows"""
+    with open(path, "r", encoding="utf-8") as results_file:
+        baseline = json.load(results_file)
+    regressions = []
+    print("%-45s %12s %12s %8s" % ("benchmark", "baseline", "now", "ratio"))
+    for result in results:
+        if result.key not in baseline:
+            continue
+        old = baseline[result.key]["seconds"]
+        ratio = result.seconds / old
+        print("%-45s %10.1fus %10.1fus %7.2fx"
+              % (result.key, old * 1e6, result.seconds * 1e6, ratio))
+        if ratio > threshold:
+            regressions.append(result.key)
+    return regressions
+
+
+def main(description: str,
+         cases: Callable[[argparse.Namespace], Iterable[Case]],
+         sizes: list, sizes_help: str,
+         add_arguments: Optional[Callable] = None, argv=None) -> list:
+    """Command line interface shared by all benchmark modules
+    add_arguments can add module-specific options to the parser,
+    cases gets all parsed arguments
+    Exits with status 1 if --compare finds a regression"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--sizes", type=int, nargs="+", default=sizes,
+                        help=sizes_help)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing runs per benchmark, the best one counts")
+    parser.add_argument("--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--json", metavar="PATH",
+                        help="save the results to a JSON file")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare with results saved by --json")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="slowdown ratio counted as a regression")
+    if add_arguments is not None:
+        add_arguments(parser)
+    args = parser.parse_args(argv)
+    results = [measure(case, args.repeat) for case in cases(args)
+               if args.filter in case.name]
+    print_results(results)
+    if args.json:
+        save_results(results, args.json)
+    if args.compare:
+        print()
+        regressions = compare_results(results, args.compare,
+                                      args.threshold)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
+    return results
@@ -0,0 +1,418 @@
+"""Load test of the real exporter against a fleet of simulated routers
+
+Every simulated router is an SSH server on its own loopback port that
+answers the commands of its backend from a generated fixture. For every
+fleet size the exporter is started in its own process with a matching
+routers.yml and scraped repeatedly.
+
+Needs asyncssh and Linux (the exporter is measured through /proc).
+Run from the repository root:
+    python -m benchmarks.loadtest [--sizes 10 100 1000] [--engine session]"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+import yaml  # type: ignore
+import asyncssh  # type: ignore
+
+from router_prometheus import transport
+
+from . import corpora
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The line SessionTransport sends after a command
+SESSION_END = "} </dev/null 2>/dev/null"
+
+
+class ServerStats:
+    """SSH activity of the whole simulated fleet,
+    only changed from the event loop thread"""
+
+    def __init__(self) -> None:
+        self.connections = 0
+        self.channels_opened = 0
+        self.channels_open = 0
+        self.channels_peak = 0
+
+
+class SimulatedRouter:
+    """Answers a backend's commands from a fixture after a delay,
+    batch scripts and SessionTransport's shell are understood as well"""
+
+    def __init__(self, fixture_path: str, latency: float,
+                 stats: ServerStats) -> None:
+        self.replay = transport.ReplayTransport(fixture_path, "root",
+                                                options={"latency": 0})
+        self.replay.connect()
+        self.latency = latency
+        self.stats = stats
+
+    async def respond(self, command: str) -> transport.CommandResult:
+        await asyncio.sleep(self.latency)
+        return self.replay.run(command, warn=True)
+
+    async def handle(self, process) -> None:
+        self.stats.channels_opened += 1
+        self.stats.channels_open += 1
+        self.stats.channels_peak = max(self.stats.channels_peak,
+                                       self.stats.channels_open)
+        try:
+            if process.command in (None, "sh"):
+                await self.shell(process)
+            else:
+                result = await self.respond(process.command)
+                process.stdout.write(result.stdout)
+                process.exit(result.exited)
+        finally:
+            self.stats.channels_open -= 1
+
+    async def shell(self, process) -> None:
+        """Speaks the protocol of SessionTransport:
+        { COMMAND\\n} </dev/null 2>/dev/null\\nprintf ... MARKER $?"""
+        lines: list = []
+        result = None
+        while True:
+            line = await process.stdin.readline()
+            if not line:
+                break
+            line = line.rstrip("\n")
+            if result is None and line == SESSION_END:
+                result = await self.respond("\n".join(lines)[2:])
+                lines = []
+            elif result is not None and line.startswith("printf "):
+                marker = line.split()[-2]
+                process.stdout.write(result.stdout + "\n" + marker + " "
+                                     + str(result.exited) + "\n")
+                result = None
+            else:
+                lines.append(line)
+        process.exit(0)
+
+
+class SimulatedServer(asyncssh.SSHServer):
+    """Accepts any user and password"""
+
+    def __init__(self, stats: ServerStats) -> None:
+        self.stats = stats
+
+    def connection_made(self, connection) -> None:
+        self.stats.connections += 1
+
+    def connection_lost(self, exc) -> None:
+        self.stats.connections -= 1
+
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return True
+
+
+class SimulatedFleet:
+    """Runs the SSH servers of all simulated routers in one event loop
+    in a background thread"""
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="simulator",
+                         daemon=True).start()
+        self.host_key = asyncssh.generate_private_key("ssh-ed25519")
+        self.stats = ServerStats()
+        self.servers: list = []
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def start_router(self, fixture_path: str, latency: float) -> int:
+        simulated = SimulatedRouter(fixture_path, latency, self.stats)
+        server = await asyncssh.create_server(
+            lambda: SimulatedServer(self.stats), "127.0.0.1", 0,
+            server_host_keys=[self.host_key],
+            process_factory=simulated.handle)
+        self.servers.append(server)
+        return server.get_port()
+
+    def start(self, fixture_path: str, latency: float) -> int:
+        """Starts a simulated router and returns its port"""
+        return self.call(self.start_router(fixture_path, latency))
+
+    async def stop_all(self) -> None:
+        for server in self.servers:
+            server.close()
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+
+    def stop(self) -> None:
+        self.call(self.stop_all())
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_configs(directory: str, routers: dict, args,
+                  port: int) -> None:
+    """Writes config.yml and routers.yml for the exporter"""
+    config_directory = os.path.join(directory, "config")
+    os.makedirs(config_directory, exist_ok=True)
+    config = {"port": port, "address": "127.0.0.1", "debug": False,
+              "cpython_metrics": False, "workers": args.workers,
+              "poll_interval": args.poll_interval, "batch": args.batch,
+              "engine": args.engine, "command_timeout": args.command_timeout,
+              "update_timeout": args.update_timeout, "probe_cache": False,
+              "processes": args.processes,
+              # Every scrape is measured, not served from the cache
+              "render_cache_seconds": 0}
+    with open(os.path.join(config_directory, "config.yml"), "w",
+              encoding="utf-8") as config_file:
+        yaml.dump(config, config_file)
+    with open(os.path.join(config_directory, "routers.yml"), "w",
+              encoding="utf-8") as routers_file:
+        yaml.dump(routers, routers_file)
+
+
+def start_exporter(directory: str) -> subprocess.Popen:
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = REPOSITORY + os.pathsep + \
+        environment.get("PYTHONPATH", "")
+    log = open(os.path.join(directory, "exporter.log"), "w",
+               encoding="utf-8")
+    return subprocess.Popen([sys.executable, "-u", "-c",
+                             "from router_prometheus.main import main; "
+                             "main()"],
+                            cwd=directory, env=environment, stdout=log,
+                            stderr=subprocess.STDOUT)
+
+
+def scrape(port: int, timeout: float) -> tuple:
+    """Returns the scrape's duration and the values of router_up"""
+    start = time.monotonic()
+    with urllib.request.urlopen("http://127.0.0.1:" + str(port)
+                                + "/metrics", timeout=timeout) as response:
+        body = response.read().decode()
+    seconds = time.monotonic() - start
+    up = [float(line.rsplit(" ", 1)[1]) for line in body.splitlines()
+          if line.startswith("router_up{")]
+    return seconds, up
+
+
+def wait_until_ready(port: int, routers: int, timeout: float) -> float:
+    """Scrapes until every router shows up, returns how long it took"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            seconds, up = scrape(port, timeout)
+        except OSError:
+            time.sleep(0.5)
+            continue
+        if len(up) == routers:
+            return time.monotonic() - start
+        time.sleep(1)
+    raise TimeoutError("Only some routers came up within "
+                       + str(timeout) + " seconds")
+
+
+def process_stats(pid: int) -> tuple:
+    """Returns the CPU seconds, RSS in MiB and number of threads
+    of a process"""
+    with open("/proc/" + str(pid) + "/stat", encoding="utf-8") as stat:
+        # The command name can contain spaces, the fields after it can't
+        fields = stat.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = 0.0
+    threads = 0
+    with open("/proc/" + str(pid) + "/status", encoding="utf-8") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return cpu, rss, threads
+
+
+def process_tree(pid: int) -> list:
+    """Returns pid and the pids of all its descendants,
+    e.g. the exporter's worker processes"""
+    parents: dict = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat", encoding="utf-8") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(parent, []).append(int(entry))
+    pids = [pid]
+    for current in pids:
+        pids.extend(parents.get(current, []))
+    return pids
+
+
+def tree_stats(pid: int) -> tuple:
+    """process_stats() summed over a process and its descendants"""
+    cpu = rss = 0.0
+    threads = 0
+    for current in process_tree(pid):
+        try:
+            stats = process_stats(current)
+        except OSError:
+            # Exited in the meantime
+            continue
+        cpu += stats[0]
+        rss += stats[1]
+        threads += stats[2]
+    return cpu, rss, threads
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run_size(simulated: SimulatedFleet, fixtures: dict, size: int,
+             args) -> dict:
+    """Runs the exporter against a fleet of size routers
+    Returns the measurements"""
+    backends = args.backends
+    routers = {}
+    for index in range(size):
+        backend = backends[index % len(backends)]
+        port = simulated.start(fixtures[backend], args.latency)
+        routers["sim" + str(index)] = {"address": "127.0.0.1:" + str(port),
+                                       "backend": backend,
+                                       "transport": {"username": "root",
+                                                     "password": "root"}}
+    directory = tempfile.mkdtemp(prefix="router_prometheus-loadtest-")
+    port = free_port()
+    write_configs(directory, routers, args, port)
+    exporter = start_exporter(directory)
+    try:
+        ready = wait_until_ready(port, size, args.init_timeout)
+        # In background mode the first scrapes can still be empty
+        if args.poll_interval > 0:
+            time.sleep(args.poll_interval)
+        scrape(port, args.scrape_timeout)
+        cpu_before = tree_stats(exporter.pid)[0]
+        channels_before = simulated.stats.channels_opened
+        simulated.stats.channels_peak = simulated.stats.channels_open
+        latencies = []
+        up: list = []
+        for _ in range(args.scrapes):
+            seconds, up = scrape(port, args.scrape_timeout)
+            latencies.append(seconds)
+            if args.poll_interval > 0:
+                time.sleep(max(args.poll_interval - seconds, 0))
+        cpu, rss, threads = tree_stats(exporter.pid)
+    except Exception:
+        print("Exporter log: " + os.path.join(directory, "exporter.log"))
+        raise
+    finally:
+        exporter.terminate()
+        try:
+            exporter.wait(10)
+        except subprocess.TimeoutExpired:
+            exporter.kill()
+        simulated.stop()
+    return {"routers": size,
+            "ready_seconds": ready,
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies),
+            "cpu_per_scrape": (cpu - cpu_before) / args.scrapes,
+            "rss_mib": rss,
+            "threads": threads,
+            "channels_per_scrape": (simulated.stats.channels_opened
+                                    - channels_before) / args.scrapes,
+            "channels_peak": simulated.stats.channels_peak,
+            "up": int(sum(up))}
+
+
+def print_row(row: dict) -> None:
+    print("%7d %7.1f %8.1f %8.1f %8.1f %8.1f %9.3f %8.1f %7d %9.1f %7d %5d"
+          % (row["routers"], row["ready_seconds"], row["p50"] * 1000,
+             row["p90"] * 1000, row["p99"] * 1000, row["max"] * 1000,
+             row["cpu_per_scrape"], row["rss_mib"], row["threads"],
+             row["channels_per_scrape"], row["channels_peak"], row["up"]))
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Exporter load test with simulated routers")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10, 100, 1000],
+                        help="numbers of simulated routers")
+    parser.add_argument("--backends", nargs="+",
+                        default=sorted(corpora.fixtures),
+                        choices=sorted(corpora.fixtures),
+                        help="backends of the routers, used in turns")
+    parser.add_argument("--stations", type=int, default=20,
+                        help="clients per simulated router")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds every simulated command takes")
+    parser.add_argument("--scrapes", type=int, default=20,
+                        help="measured scrapes per fleet size")
+    parser.add_argument("--engine", default="fabric",
+                        help="exporter option, see config.yml")
+    parser.add_argument("--batch", action="store_true",
+                        help="exporter option, see config.yml")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="exporter option, see config.yml")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="exporter option, see config.yml")
+    parser.add_argument("--poll-interval", type=float, default=0,
+                        help="exporter option, see config.yml")
+    parser.add_argument("--command-timeout", type=float, default=10,
+                        help="exporter option, see config.yml")
+    parser.add_argument("--update-timeout", type=float, default=30,
+                        help="exporter option, see config.yml")
+    parser.add_argument("--init-timeout", type=float, default=300,
+                        help="seconds to wait for all routers to come up")
+    parser.add_argument("--scrape-timeout", type=float, default=120,
+                        help="seconds a single scrape may take")
+    parser.add_argument("--json", metavar="PATH",
+                        help="save the results to a JSON file")
+    args = parser.parse_args(argv)
+    # Every router needs a listening socket, a server and a client
+    # connection, the default limit of open files is hit quickly
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    fixture_directory = tempfile.mkdtemp(prefix="router_prometheus-fixtures-")
+    fixtures = {}
+    for backend in args.backends:
+        fixtures[backend] = os.path.join(fixture_directory, backend + ".json")
+        transport.save_fixture(fixtures[backend],
+                               corpora.fixtures[backend](args.stations))
+    simulated = SimulatedFleet()
+    print("routers ready/s  p50 ms   p90 ms   p99 ms   max ms   cpu/scr"
+          "  rss MiB threads  chan/scr  ch.peak    up")
+    rows = []
+    for size in args.sizes:
+        row = run_size(simulated, fixtures, size, args)
+        print_row(row)
+        rows.append(row)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as results_file:
+            json.dump(rows, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
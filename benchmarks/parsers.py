@@ -0,0 +1,76 @@
+"""Benchmarks the output parsers of the router backends
+against generated corpora, no router needed
+
+Run from the repository root:
+    python -m benchmarks.parsers [--sizes 5 50 500] [--json results.json]"""
+from functools import partial
+
+from router_prometheus import router
+
+from . import corpora, harness
+
+
+def legacy_iw_dump_ss(iwdump):
+    """The signal-only station dump parser OpenWrt used before
+    parse_station_dump(), kept as a baseline"""
+    ss_dict = {}
+    for index, line in enumerate(iwdump):
+        if line.strip().split()[0] == "Station":
+            address = line.strip().split()[1]
+        if line.strip().split()[0] == "signal:":
+            ss = line.strip().split()[1]
+            ss_dict[address] = ss
+    return ss_dict
+
+
+def check_station_dump(iwdump):
+    """Both parsers have to find the same signal values"""
+    stations = router.parse_station_dump(iwdump)
+    signals = {address: str(station.signal)
+               for address, station in stations.items()}
+    if signals != legacy_iw_dump_ss(iwdump):
+        raise AssertionError("parse_station_dump doesn't match "
+                             "the legacy parser")
+
+
+def parse_ate_output(rtr, ate_output):
+    return (rtr.ate_output_ss(ate_output, "ra0"),
+            rtr.ate_output_ss(ate_output, "rai0"))
+
+
+def cases(args):
+    for size in args.sizes:
+        iwdump = corpora.iw_station_dump(size).strip().splitlines()
+        check_station_dump(iwdump)
+        yield harness.Case("openwrt legacy iw_dump_ss", size,
+                           partial(legacy_iw_dump_ss, iwdump))
+        yield harness.Case("openwrt parse_station_dump", size,
+                           partial(router.parse_station_dump, iwdump))
+        dsl = corpora.parser_router(router.Dslac55uRouter)
+        yield harness.Case("dsl-ac55u ate_output_ss", size,
+                           partial(parse_ate_output, dsl,
+                                   corpora.ate_show_stainfo(size)))
+        ddwrt = corpora.parser_router(router.DdwrtRouter)
+        yield harness.Case("dd-wrt parse_rssi_output", size,
+                           partial(ddwrt.parse_rssi_output,
+                                   corpora.wl_rssi(size)))
+
+
+def print_speedups(results):
+    """Compares the single pass station dump parser to the old one,
+    which only read the signal"""
+    legacy = {result.size: result.seconds for result in results
+              if result.name == "openwrt legacy iw_dump_ss"}
+    for result in results:
+        if result.name == "openwrt parse_station_dump" and \
+           result.size in legacy:
+            print("parse_station_dump is %.1fx faster than the legacy parser"
+                  " with %d stations"
+                  % (legacy[result.size] / result.seconds, result.size))
+
+
+if __name__ == "__main__":
+    print_speedups(harness.main("Router output parser benchmarks", cases,
+                                [5, 50, 500],
+                                "numbers of stations in the generated "
+                                "corpora"))
@@ -0,0 +1,39 @@
+import time
+
+# Number of failures in a row after which a router gets skipped
+FAILURE_THRESHOLD = 3
+# How long a router is skipped for after reaching the threshold,
+# doubled with every further failure
+BASE_BACKOFF = 15.0
+
+
+class CircuitBreaker:
+    """Keeps track of a router's failures and decides when to try it again
+    After FAILURE_THRESHOLD failures in a row the router is skipped
+    with an exponentially growing pause, capped at max_backoff"""
+
+    def __init__(self, max_backoff: float = 600.0) -> None:
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        """True while the router is being skipped"""
+        return time.monotonic() < self.retry_at
+
+    def success(self) -> None:
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failure(self) -> float:
+        """Records a failure
+        Returns the number of seconds the router will be skipped for"""
+        self.failures += 1
+        if self.failures < FAILURE_THRESHOLD:
+            return 0.0
+        # The exponent is capped so that the pause can't overflow
+        exponent = min(self.failures - FAILURE_THRESHOLD, 32)
+        backoff = min(BASE_BACKOFF * 2 ** exponent, self.max_backoff)
+        self.retry_at = time.monotonic() + backoff
+        return backoff
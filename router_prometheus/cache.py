@@ -0,0 +1,62 @@
+import os
+import json
+import threading
+
+# Bump whenever the stored probe results change meaning,
+# caches written by other versions are ignored
+CACHE_VERSION = 1
+
+
+class ProbeCache:
+    """Stores the probe results of all routers in a JSON file
+    so that they don't have to be detected again after a restart"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: dict = {}
+        try:
+            with open(path, "r", encoding="utf-8") as cache_file:
+                content = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            print("Probe cache is unreadable, ignoring it")
+            return
+        if content.get("version") != CACHE_VERSION:
+            print("Probe cache was written by a different version, "
+                  + "ignoring it")
+            return
+        self.entries = content.get("routers", {})
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key: str, entry: dict) -> None:
+        """Stores an entry, the file is only written when it changes"""
+        # Round trip through JSON so that the cache doesn't keep
+        # references to the router's own (mutable) attributes
+        entry = json.loads(json.dumps(entry))
+        with self.lock:
+            if self.entries.get(key) == entry:
+                return
+            self.entries[key] = entry
+            self.save()
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.save()
+
+    def save(self) -> None:
+        """Writes the cache, has to be called with the lock held"""
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "w", encoding="utf-8") as cache_file:
+                json.dump({"version": CACHE_VERSION,
+                           "routers": self.entries}, cache_file)
+            # Replacing the file makes sure it is never half-written
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print("Unable to write the probe cache: " + str(e))
@@ -4,3 +4,33 @@ class ConnectionFailed(Exception):
 
 class MissingCommand(Exception):
     pass
+
+
+class CommandFailed(Exception):
+    pass
+
+
+class UnknownEngine(Exception):
+    pass
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class UnknownBackend(Exception):
+    pass
+
+
+class NotPrefetched(Exception):
+    """Raised by Router.run() during Router.update_async()
+    for a command whose result has to be awaited first"""
+
+    def __init__(self, command, warn):
+        super().__init__(command)
+        self.command = command
+        self.warn = warn
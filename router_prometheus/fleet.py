@@ -0,0 +1,230 @@
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko  # type: ignore
+
+from . import router
+from . import exceptions
+
+# Delay before the first retry of a router that failed to initialize,
+# doubled with every further failure
+RETRY_DELAY = 15.0
+MAX_RETRY_DELAY = 600.0
+# Routers with an asynchronous transport only need a thread while they
+# connect and probe, with workers = 0 they share this many
+ASYNC_INIT_WORKERS = 16
+
+
+def create_router(name: str, routerconfig: dict,
+                  cache=None) -> router.Router:
+    """Returns a router object for the backend set in routerconfig"""
+    backend = routerconfig["backend"]
+    if backend not in router.backends:
+        raise exceptions.UnknownBackend(backend)
+    return router.backends[backend]({name: routerconfig}, cache)
+
+
+class Fleet:
+    """Brings the configured routers online in the background
+    All routers are initialized at the same time, the ones that fail
+    are retried with a growing delay and added to routers once ready"""
+
+    def __init__(self, routers_config: dict, defaults: dict,
+                 workers: int = 0, cache=None) -> None:
+        # defaults are options from config.yml that routers.yml can override
+        self.defaults = defaults
+        self.routers_config = self.merge_defaults(routers_config)
+        # Ready router objects in the order of routers.yml
+        # The list is replaced as a whole on every change, so readers
+        # can iterate over it without locking
+        self.routers: list = []
+        self.ready: dict = {}
+        self.failures: dict = {}
+        self.retry_at: dict = {}
+        self.lock = threading.Lock()
+        # Shared ProbeCache, None disables caching
+        self.cache = cache
+        # 0 means one worker per router, resized by reconcile()
+        self.workers = workers
+        self.executor_size = self.wanted_executor_size()
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_size,
+                                           thread_name_prefix="init")
+
+    def merge_defaults(self, routers_config: dict) -> dict:
+        """Returns routers_config with the defaults filled in,
+        dict options like feature_intervals are merged key by key"""
+        merged = {}
+        for name in routers_config:
+            routerconfig = {**self.defaults, **routers_config[name]}
+            for option, value in self.defaults.items():
+                if isinstance(value, dict) and \
+                   isinstance(routers_config[name].get(option), dict):
+                    routerconfig[option] = {**value,
+                                            **routers_config[name][option]}
+            merged[name] = routerconfig
+        return merged
+
+    def wanted_executor_size(self) -> int:
+        if self.workers < 1:
+            asynchronous = len([name for name, routerconfig
+                                in self.routers_config.items()
+                                if router.is_asynchronous(routerconfig)])
+            return max(len(self.routers_config) - asynchronous
+                       + min(asynchronous, ASYNC_INIT_WORKERS), 1)
+        return self.workers
+
+    def resize_executor(self) -> None:
+        """Replaces the executor when the number of routers changed,
+        so that every router still gets its own worker
+        Tasks queued on the old one still run, its idle threads exit"""
+        with self.lock:
+            size = self.wanted_executor_size()
+            if size == self.executor_size:
+                return
+            old_executor = self.executor
+            self.executor_size = size
+            self.executor = ThreadPoolExecutor(max_workers=size,
+                                               thread_name_prefix="init")
+        old_executor.shutdown(wait=False)
+
+    def submit(self, function, *args) -> None:
+        """Runs function on the executor, which resize_executor()
+        may replace at any time"""
+        with self.lock:
+            self.executor.submit(function, *args)
+
+    def start(self) -> None:
+        """Starts initializing all routers, returns immediately"""
+        for name in self.routers_config:
+            self.submit(self.initialize, name)
+        threading.Thread(target=self.retry_loop, name="init-retry",
+                         daemon=True).start()
+
+    def initialize(self, name: str) -> None:
+        routerconfig = self.routers_config.get(name)
+        if routerconfig is None:
+            # Removed from routers.yml while waiting for a retry
+            return
+        try:
+            router_object = create_router(name, routerconfig, self.cache)
+            print(router_object)
+        except exceptions.UnknownBackend:
+            # Configuration errors won't go away by retrying
+            print(name + ": No such backend: " + routerconfig["backend"])
+            return
+        except exceptions.UnknownEngine as e:
+            print(name + ": No such transport engine: " + str(e))
+            return
+        except paramiko.ssh_exception.NoValidConnectionsError:
+            print("Error connecting to router " + name)
+        except socket.gaierror:
+            print("Could not resolve address: " + routerconfig["address"])
+        except exceptions.MissingCommand:
+            print(name + " is missing both the 'wl' and 'wl_atheros' commands")
+        except TimeoutError:
+            print("Connecting to " + name + " timed out")
+        except Exception as e:
+            print(name + ": Initialization failed: " + repr(e))
+        else:
+            self.add(name, routerconfig, router_object)
+            return
+        self.schedule_retry(name, routerconfig)
+
+    def add(self, name: str, routerconfig: dict,
+            router_object: router.Router) -> None:
+        with self.lock:
+            # The config may have changed while the router was connecting
+            current = self.routers_config.get(name) is routerconfig
+            if current:
+                self.failures.pop(name, None)
+                self.ready[name] = router_object
+                self.update_routers()
+        if not current:
+            self.close(router_object)
+
+    def update_routers(self) -> None:
+        """Rebuilds the list of ready routers,
+        has to be called with the lock held"""
+        self.routers = [self.ready[rtr] for rtr in self.routers_config
+                        if rtr in self.ready]
+
+    def get(self, name: str) -> router.Router | None:
+        """Returns the router if it is ready"""
+        return self.ready.get(name)
+
+    def is_current(self, router_object: router.Router) -> bool:
+        """Whether the router object still belongs to the fleet"""
+        return self.ready.get(router_object.name) is router_object
+
+    def reconcile(self, routers_config: dict) -> set:
+        """Applies a new routers.yml without restarting
+        Routers whose config didn't change keep their objects and
+        connections, new and changed ones are initialized in the background
+        Returns the names of the routers that were removed or replaced"""
+        new_config = self.merge_defaults(routers_config)
+        with self.lock:
+            old_config = self.routers_config
+            dropped = {name for name in old_config
+                       if old_config[name] != new_config.get(name)}
+            added = [name for name in new_config
+                     if old_config.get(name) != new_config[name]]
+            # Unchanged routers keep the same dict, which add() compares
+            for name in new_config:
+                if name not in dropped and name in old_config:
+                    new_config[name] = old_config[name]
+            self.routers_config = new_config
+            removed_objects = []
+            for name in dropped:
+                self.failures.pop(name, None)
+                self.retry_at.pop(name, None)
+                if name in self.ready:
+                    removed_objects.append(self.ready.pop(name))
+            self.update_routers()
+        self.resize_executor()
+        for router_object in removed_objects:
+            if router_object.name in new_config:
+                router_object.rprint("Config changed, reconnecting...")
+            else:
+                router_object.rprint("Removed from the routers config")
+                if self.cache is not None:
+                    self.cache.delete(router_object.cache_key())
+            # The replacement may have another backend or transport,
+            # it starts its own series
+            router_object.metrics.remove()
+            self.submit(self.close, router_object)
+        for name in added:
+            self.submit(self.initialize, name)
+        return dropped
+
+    def close(self, router_object: router.Router) -> None:
+        try:
+            if router_object.transport is not None:
+                router_object.transport.close()
+        except Exception as e:
+            router_object.rprint("Closing the connection failed: "
+                                 + repr(e))
+
+    def schedule_retry(self, name: str, routerconfig: dict) -> None:
+        with self.lock:
+            if self.routers_config.get(name) is not routerconfig:
+                return
+            failures = self.failures.get(name, 0)
+            self.failures[name] = failures + 1
+            delay = min(RETRY_DELAY * 2 ** min(failures, 32), MAX_RETRY_DELAY)
+            self.retry_at[name] = time.monotonic() + delay
+        print(name + ": Retrying in " + str(int(delay)) + " seconds")
+
+    def retry_loop(self) -> None:
+        """Submits routers whose retry delay ran out"""
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            with self.lock:
+                due = [name for name, at in self.retry_at.items()
+                       if at <= now]
+                for name in due:
+                    del self.retry_at[name]
+            for name in due:
+                self.submit(self.initialize, name)
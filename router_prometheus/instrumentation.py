@@ -0,0 +1,79 @@
+from prometheus_client import Counter, Histogram  # type: ignore
+
+# Most commands take a few milliseconds on a LAN, slow routers and
+# big outputs take seconds, command_timeout is 10 seconds by default
+COMMAND_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+UPDATE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The metrics are registered by register(), so that importing the
+# package doesn't add them to every registry
+command_duration = Histogram(
+    'router_exporter_command_duration_seconds',
+    'Time a command took on the router, including the SSH round trip',
+    ["router", "backend", "feature"], buckets=COMMAND_BUCKETS,
+    registry=None)
+channels_opened = Counter(
+    'router_exporter_ssh_channels_opened',
+    'SSH channels opened to the router',
+    ["router"], registry=None)
+reconnects = Counter(
+    'router_exporter_reconnects',
+    'Times the connection to the router was opened again',
+    ["router"], registry=None)
+update_failures = Counter(
+    'router_exporter_update_failures',
+    'Failed updates of the router',
+    ["router"], registry=None)
+update_duration = Histogram(
+    'router_exporter_update_duration_seconds',
+    'Time a whole update of the router took',
+    ["router"], buckets=UPDATE_BUCKETS, registry=None)
+collect_duration = Histogram(
+    'router_exporter_collect_duration_seconds',
+    'Time spent in each phase of a scrape',
+    ["phase"], buckets=UPDATE_BUCKETS, registry=None)
+
+# Metrics of the routers, which live in the worker processes
+# when the routers are sharded
+router_metrics = [command_duration, channels_opened, reconnects,
+                  update_failures, update_duration]
+metrics = router_metrics + [collect_duration]
+
+
+def register(registry) -> None:
+    for metric in metrics:
+        registry.register(metric)
+
+
+class RouterMetrics:
+    """The label children of a single router
+    Children are looked up once, so that instrumenting a command
+    is only a dict lookup and a histogram observation"""
+
+    def __init__(self, name: str, backend: str) -> None:
+        self.name = name
+        self.backend = backend
+        # Feature -> command_duration child
+        self.commands: dict = {}
+        self.channels = channels_opened.labels(name)
+        self.reconnects = reconnects.labels(name)
+        self.failures = update_failures.labels(name)
+        self.updates = update_duration.labels(name)
+
+    def observe_command(self, feature: str, seconds: float,
+                        channels: int) -> None:
+        child = self.commands.get(feature)
+        if child is None:
+            child = self.commands[feature] = command_duration.labels(
+                self.name, self.backend, feature)
+        child.observe(seconds)
+        if channels:
+            self.channels.inc(channels)
+
+    def remove(self) -> None:
+        """Drops the router's series once it's gone from routers.yml"""
+        for feature in self.commands:
+            command_duration.remove(self.name, self.backend, feature)
+        for metric in [channels_opened, reconnects, update_failures,
+                       update_duration]:
+            metric.remove(self.name)
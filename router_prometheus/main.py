@@ -2,20 +2,30 @@ import os
 import sys
 import logging
 import signal
-import socket
+import time
+import bisect
+import heapq
+import threading
 
 import yaml  # type: ignore
-import paramiko  # type: ignore
-from prometheus_client import start_http_server  # type: ignore
 from prometheus_client import PLATFORM_COLLECTOR  # type: ignore
 from prometheus_client import PROCESS_COLLECTOR  # type: ignore
 from prometheus_client.core import GaugeMetricFamily, REGISTRY  # type: ignore
+from prometheus_client.core import CounterMetricFamily  # type: ignore
+from prometheus_client.core import HistogramMetricFamily  # type: ignore
 
-from typing import Type, Generator
+from typing import Generator
 
 # Custom modules import
 from . import router
-from . import exceptions
+from . import fleet
+from . import poller
+from . import cache
+from . import mapping
+from . import instrumentation
+from . import profiling
+from . import server
+from . import shards
 
 CONFIG_DIRECTORY = os.getcwd() + "/config/"
 if os.getcwd() == "/":
@@ -23,6 +33,43 @@ if os.getcwd() == "/":
 MAIN_CONFIG_LOCATION = CONFIG_DIRECTORY + "config.yml"
 ROUTERS_CONFIG_LOCATION = CONFIG_DIRECTORY + "routers.yml"
 MAPPING_CONFIG_LOCATION = CONFIG_DIRECTORY + "mapping.yml"
+CLIENT_LABELS = ["router", "clientname", "interface", "band", "networkname"]
+INTERFACE_LABELS = ["router", "interface", "band", "networkname"]
+# Which clients get their own series (client_series in config.yml):
+#  all       - every client
+#  mapped    - only the clients in mapping.yml
+#  top_k     - the client_top_k clients with the strongest signal
+#              of each interface
+#  histogram - none, the signal of each interface is exported
+#              as a distribution instead
+CLIENT_SERIES = ["all", "mapped", "top_k", "histogram"]
+# Bucket bounds of the signal histogram in dBm, around the usual
+# unusable/poor/fair/good/excellent thresholds of Wi-Fi signal strength
+SIGNAL_BUCKETS = (-90.0, -80.0, -70.0, -67.0, -60.0, -50.0, -30.0)
+# Station field -> metric key in create_gauges() and the factor
+# which converts the value to base units
+STATION_METRICS = {"tx_bitrate": ("client_tx_bitrate", 1e6),
+                   "rx_bitrate": ("client_rx_bitrate", 1e6),
+                   "rx_bytes": ("client_rx_bytes", 1),
+                   "tx_bytes": ("client_tx_bytes", 1),
+                   "inactive_time": ("client_inactive", 1e-3),
+                   "connected_time": ("client_connected", 1)}
+# StationTable column, metric key and factor of the station fields
+STATION_COLUMNS = [(router.Station._fields.index(field), key, factor)
+                   for field, (key, factor) in STATION_METRICS.items()]
+# InterfaceCounters field -> counter name and description
+NET_METRICS = {
+    "rx_bytes": ("router_network_receive_bytes", "Bytes received"),
+    "rx_packets": ("router_network_receive_packets", "Packets received"),
+    "rx_errors": ("router_network_receive_errors", "Receive errors"),
+    "rx_drops": ("router_network_receive_drops",
+                 "Received packets dropped"),
+    "tx_bytes": ("router_network_transmit_bytes", "Bytes sent"),
+    "tx_packets": ("router_network_transmit_packets", "Packets sent"),
+    "tx_errors": ("router_network_transmit_errors", "Transmit errors"),
+    "tx_drops": ("router_network_transmit_drops",
+                 "Packets dropped while sending")}
+PROBE_CACHE_LOCATION = CONFIG_DIRECTORY + "probe_cache.json"
 
 
 def load_main_config() -> dict | None:
@@ -63,28 +110,65 @@ def load_routers_config() -> dict | None:
         return None
 
 
-def load_mapping_config() -> dict | None:
-    """Same as load_routers_config() but with the mapping config and without
-    creating the file"""
+def reload_routers_config(router_poller) -> None:
+    """Applies a changed routers config to the running fleet,
+    a missing or broken file keeps the current routers"""
     try:
-        with open(MAPPING_CONFIG_LOCATION,
+        with open(ROUTERS_CONFIG_LOCATION,
                   "r",
-                  encoding="utf-8") as mapping_config:
-            mapping = yaml.safe_load(mapping_config)
-        mapping_uppercase = {}
-        for mac in mapping:
-            mapping_uppercase[mac.upper()] = mapping[mac]
-        return mapping_uppercase
-    except FileNotFoundError:
-        print("Mapping config does not exist, mapping disabled...")
+                  encoding="utf-8") as routers_config:
+            config = yaml.safe_load(routers_config)
+    except (OSError, yaml.YAMLError) as e:
+        print("Unable to reload the routers config: " + str(e))
+        return
+    if not isinstance(config, dict):
+        print("Routers config is empty, keeping the current routers")
+        return
+    print("Routers config changed, reloading...")
+    router_poller.reconcile(config)
+
+
+def watch_routers_config(router_poller, interval: float) -> None:
+    """Checks the routers config for changes every interval seconds"""
+    state = config_file_state(ROUTERS_CONFIG_LOCATION)
+    while True:
+        time.sleep(interval)
+        new_state = config_file_state(ROUTERS_CONFIG_LOCATION)
+        if new_state == state:
+            continue
+        state = new_state
+        try:
+            reload_routers_config(router_poller)
+        except Exception as e:
+            print("Routers config reload failed: " + repr(e))
+
+
+def config_file_state(path: str) -> tuple | None:
+    """Returns the modification time and size of a file"""
+    try:
+        stat = os.stat(path)
+    except OSError:
         return None
+    return (stat.st_mtime_ns, stat.st_size)
 
 
 def create_main_config() -> None:
     """Creates an example main config file"""
     print("Creating an example main config file...")
     config = {"cpython_metrics": False, "port": 9000,
-              "address": "127.0.0.1", "debug": False}
+              "address": "127.0.0.1", "debug": False, "workers": 0,
+              "poll_interval": 0, "batch": False,
+              "engine": "fabric", "command_timeout": 10,
+              "update_timeout": 30, "max_backoff": 600,
+              "interface_ttl": 3600, "probe_cache": True,
+              "mapping_reload_interval": 5, "routers_reload_interval": 5,
+              "feature_intervals": {"proc": 15, "signal": 30,
+                                    "channel": 600, "ssid": 600,
+                                    "int_detect": 3600},
+              "extra_interfaces": [], "self_metrics": True,
+              "profiling": False, "multi_target": False,
+              "render_cache_seconds": 1, "client_series": "all",
+              "client_top_k": 10, "processes": 0}
     try:
         with open(MAIN_CONFIG_LOCATION, "w", encoding="utf-8") as main_config:
             yaml.dump(config, main_config)
@@ -130,173 +214,420 @@ def create_routers_config() -> None:
     sys.exit()
 
 
-def create_router_list(routers_dict: dict) -> list:
-    """Returns a list of router objects"""
-    routers = []
-    for rtr in routers_dict:
-        router_class: Type[router.Router] = router.Router
-        match routers_dict[rtr]["backend"]:
-            case "dd-wrt":
-                router_class = router.DdwrtRouter
-            case "openwrt":
-                router_class = router.OwrtRouter
-            case "ubnt":
-                router_class = router.UbntRouter
-            case "dsl-ac55U":
-                router_class = router.Dslac55uRouter
-            case _:
-                print(rtr + ": No such backend: " + routers_dict[rtr]["backend"])
-                continue
-        try:
-            router_object = router_class({rtr: routers_dict[rtr]})
-            print(router_object)
-        except paramiko.ssh_exception.NoValidConnectionsError:
-            print("Error connecting to router " + rtr)
-        except socket.gaierror:
-            print("Could not resolve address: " + routers_dict[rtr]["address"])
-        except exceptions.MissingCommand:
-            print(rtr + " is missing both the 'wl' and 'wl_atheros' commands")
-        except TimeoutError:
-            print("Connecting to " + rtr + " timed out")
-        else:
-            routers.append(router_object)
-    return routers
-
-
-def translate_macs(rssi_dict: dict) -> dict:
-    """Uses the mapping dict and replaces known MAC addresses in rssi_dict
-    with nicknames from mapping
-    returns the modified dict"""
-    translated_dict = {}
-    if rssi_dict is not None and MAPPING is not None:
-        for mac in rssi_dict.keys():
-            if mac.upper() in MAPPING:
-                translated_dict.update({MAPPING[mac.upper()]: rssi_dict[mac]})
-            else:
-                translated_dict.update({mac.upper(): rssi_dict[mac]})
-        return translated_dict
-    else:
-        return rssi_dict
-
-
 class RouterCollector:
     """Custom collector class for prometheus_client"""
 
-    def __init__(self, routers: list) -> None:
-        self.routers = routers
+    def __init__(self, router_poller,
+                 background: bool = False,
+                 mac_mapping: mapping.MacMapping | None = None,
+                 client_series: str = "all", top_k: int = 10) -> None:
+        # Poller or, with the routers split across processes,
+        # ShardedPoller
+        self.poller = router_poller
+        self.mapping = mac_mapping
+        # One of CLIENT_SERIES
+        self.client_series = client_series
+        self.top_k = top_k
+        # In background mode scrapes only render the latest snapshots,
+        # otherwise every scrape refreshes all routers first
+        self.background = background
+        self.refresh_duration = instrumentation.collect_duration.labels(
+            "refresh")
+        self.render_duration = instrumentation.collect_duration.labels(
+            "render")
+
+    def create_gauges(self) -> dict:
+        """Returns a dict of the empty metric families
+        shared by all routers"""
+        gauges: dict = {}
+        gauges["load"] = GaugeMetricFamily('router_system_load',
+                                           'Average system load',
+                                           labels=["router", "t"])
+        gauges["mem"] = GaugeMetricFamily('router_mem_percent_used',
+                                          'Percent of memory used',
+                                          labels=["router"])
+        # TODO: Reimplement temperature monitoring
+        gauges["temp"] = GaugeMetricFamily('router_thermal',
+                                           'Router temperature probes',
+                                           labels=["router"])
+        gauges["signal"] = GaugeMetricFamily('router_ap_client_signal',
+                                             'Client Signal Strength',
+                                             labels=CLIENT_LABELS)
+        gauges["client_tx_bitrate"] = GaugeMetricFamily(
+            'router_ap_client_tx_bitrate_bits_per_second',
+            'Bitrate of the last frame sent to the client',
+            labels=CLIENT_LABELS)
+        gauges["client_rx_bitrate"] = GaugeMetricFamily(
+            'router_ap_client_rx_bitrate_bits_per_second',
+            'Bitrate of the last frame received from the client',
+            labels=CLIENT_LABELS)
+        gauges["client_rx_bytes"] = CounterMetricFamily(
+            'router_ap_client_rx_bytes', 'Bytes received from the client',
+            labels=CLIENT_LABELS)
+        gauges["client_tx_bytes"] = CounterMetricFamily(
+            'router_ap_client_tx_bytes', 'Bytes sent to the client',
+            labels=CLIENT_LABELS)
+        gauges["client_inactive"] = GaugeMetricFamily(
+            'router_ap_client_inactive_seconds',
+            'Time since the last activity of the client',
+            labels=CLIENT_LABELS)
+        gauges["client_connected"] = GaugeMetricFamily(
+            'router_ap_client_connected_seconds',
+            'Time the client has been connected for',
+            labels=CLIENT_LABELS)
+        gauges["clients"] = GaugeMetricFamily('router_ap_clients',
+                                              'Connected clients',
+                                              labels=INTERFACE_LABELS)
+        if self.client_series == "histogram":
+            gauges["signal_histogram"] = HistogramMetricFamily(
+                'router_ap_client_signal_dbm',
+                'Signal strength of the connected clients',
+                labels=INTERFACE_LABELS)
+            gauges["signal_min"] = GaugeMetricFamily(
+                'router_ap_client_signal_min',
+                'Weakest client signal strength', labels=INTERFACE_LABELS)
+            gauges["signal_median"] = GaugeMetricFamily(
+                'router_ap_client_signal_median',
+                'Median client signal strength', labels=INTERFACE_LABELS)
+            gauges["signal_max"] = GaugeMetricFamily(
+                'router_ap_client_signal_max',
+                'Strongest client signal strength', labels=INTERFACE_LABELS)
+        gauges["channel"] = GaugeMetricFamily('router_ap_channel',
+                                              'Current wireless channel',
+                                              labels=INTERFACE_LABELS)
+        gauges["tx"] = GaugeMetricFamily('router_net_sent',
+                                         'Bytes sent (deprecated, use '
+                                         'router_network_transmit_bytes)',
+                                         labels=["router", "interface"])
+        gauges["rx"] = GaugeMetricFamily('router_net_recv',
+                                         'Bytes received (deprecated, use '
+                                         'router_network_receive_bytes)',
+                                         labels=["router", "interface"])
+        for field, (name, documentation) in NET_METRICS.items():
+            gauges[field] = CounterMetricFamily(
+                name, documentation, labels=["router", "interface"])
+        gauges["up"] = GaugeMetricFamily('router_up',
+                                         'Whether the last update of the '
+                                         'router was successful',
+                                         labels=["router"])
+        gauges["success"] = GaugeMetricFamily(
+            'router_last_success_timestamp',
+            'Time of the last successful update in seconds since epoch',
+            labels=["router"])
+        gauges["age"] = GaugeMetricFamily('router_snapshot_age_seconds',
+                                          'Age of the served data in seconds',
+                                          labels=["router"])
+        return gauges
 
     def collect(self) -> Generator:
         """This is the function internally called by prometheus_client"""
-        gauges = []
-        load_gauge = GaugeMetricFamily('router_system_load',
-                                       'Average system load',
-                                       labels=["router", "t"])
-        mem_gauge = GaugeMetricFamily('router_mem_percent_used',
-                                      'Percent of memory used',
-                                      labels=["router"])
-        # TODO: Reimplement temperature monitoring
-        temp_gauge = GaugeMetricFamily('router_thermal',
-                                       'Router temperature probes',
-                                       labels=["router"])
-        signal_gauge = GaugeMetricFamily('router_ap_client_signal',
-                                         'Client Signal Strength',
-                                         labels=["router",
-                                                 "clientname", "interface",
-                                                 "band", "networkname"])
-        channgel_gauge = GaugeMetricFamily('router_ap_channel',
-                                           'Current wireless channel',
-                                           labels=["router", "interface",
-                                                   "band", "networkname"])
-        tx_gauge = GaugeMetricFamily('router_net_sent',
-                                     'Bytes sent',
-                                     labels=["router", "interface"])
-        rx_gauge = GaugeMetricFamily('router_net_recv',
-                                     'Bytes received',
-                                     labels=["router", "interface"])
-        # There has to be a nicer way to append all of these
-        gauges.append(load_gauge)
-        gauges.append(mem_gauge)
-        gauges.append(temp_gauge)
-        gauges.append(signal_gauge)
-        gauges.append(channgel_gauge)
-        gauges.append(tx_gauge)
-        gauges.append(rx_gauge)
-        for rtr in self.routers:
-            rtr.update()
-            if "proc" in rtr.supported_features:
-                for i, l in enumerate(["1", "5", "15"]):
-                    load_gauge.add_metric(labels=[rtr.name, l + "m"],
+        updated: set = set()
+        with profiling.profiler.profiled():
+            if not self.background:
+                with self.refresh_duration.time():
+                    updated = self.poller.refresh_all()
+            with self.render_duration.time():
+                gauges = self.render(updated)
+        for gauge in gauges.values():
+            yield gauge
+
+    def probe(self, name: str, timeout: float | None) -> list | None:
+        """Collects a single router for the /probe endpoint,
+        waiting no longer than timeout for its update
+        Returns None if there is no such router in routers.yml"""
+        if not self.poller.configured(name):
+            return None
+        started = time.perf_counter()
+        updated = set()
+        with profiling.profiler.profiled():
+            if self.background:
+                rtr, _ = self.poller.target(name, refresh=False)
+            else:
+                with self.refresh_duration.time():
+                    rtr, ok = self.poller.target(name, timeout)
+                if ok:
+                    updated.add(name)
+            with self.render_duration.time():
+                gauges = self.render(updated, [] if rtr is None else [rtr])
+        if rtr is None:
+            # Still connecting or waiting for a retry
+            gauges["up"].add_metric(labels=[name], value=0)
+        duration = GaugeMetricFamily('router_probe_duration_seconds',
+                                     'Time the probe of the router took',
+                                     value=time.perf_counter() - started)
+        return list(gauges.values()) + [duration]
+
+    def render(self, updated: set, routers: list | None = None) -> dict:
+        """Fills the metric families with the latest snapshots of routers
+        (all of them by default), updated are the routers refreshed
+        by this scrape"""
+        gauges = self.create_gauges()
+        snapshots = self.poller.snapshots
+        now = time.time()
+        if routers is None:
+            routers = self.poller.routers
+        for rtr in routers:
+            if self.background:
+                up = self.poller.healthy(rtr) and rtr.name in snapshots
+            else:
+                up = rtr.name in updated
+            gauges["up"].add_metric(labels=[rtr.name], value=int(up))
+            if rtr.name not in snapshots:
+                continue
+            snapshot = snapshots[rtr.name]
+            gauges["success"].add_metric(labels=[rtr.name],
+                                         value=snapshot.timestamp)
+            gauges["age"].add_metric(labels=[rtr.name],
+                                     value=now - snapshot.timestamp)
+            # Without background polling, routers that failed to update
+            # during this scrape are left out
+            if not self.background and rtr.name not in updated:
+                continue
+            self.add_router_metrics(gauges, snapshot)
+        return gauges
+
+    def add_router_metrics(self, gauges: dict, rtr: router.RouterSnapshot
+                           ) -> None:
+        """Adds the data from a router's snapshot to the shared gauges"""
+        if "proc" in rtr.supported_features:
+            for i, l in enumerate(["1", "5", "15"]):
+                gauges["load"].add_metric(labels=[rtr.name, l + "m"],
                                           value=rtr.loads[i])
-                mem_gauge.add_metric(labels=[rtr.name],
+            gauges["mem"].add_metric(labels=[rtr.name],
                                      value=rtr.mem_used)
-            if "thermal" in rtr.supported_features:
-                pass
-            #    yield GaugeMetricFamily('router_cpu_temp',
-            #                            'CPU temperature',
-            #                            value=rtr.dmu_temp)
-            #    yield GaugeMetricFamily(router_name + '_temp_' + interface,
-            #                            'Interface temperature',
-            #                            value=rtr.int_temperatures[index])
-            for index, interface in enumerate(rtr.wireless_interfaces):
-                band = ""
-                networkname = ""
-                if "channel" in rtr.supported_features and \
-                   len(rtr.channels) != 0:
-                    if int(rtr.channels[index]) < 15 and \
-                       int(rtr.channels[index]) > 0:
-                        band = "2.4"
-                    elif int(rtr.channels[index]) < 178 and int(
-                             rtr.channels[index]) > 31:
-                        band = "5"
-                    elif int(rtr.channels[index]) == 0:
-                        band = "OFF"
-                if "ssid" in rtr.supported_features:
-                    networkname = rtr.ssids[interface]
-                if "signal" in rtr.supported_features:
-                    if len(rtr.ss_dicts) == 0:
-                        clients = {}
-                    else:
-                        clients = translate_macs(rtr.ss_dicts[index])
-                    for client in list(clients.keys()):
-                        signal_gauge.add_metric(labels=[rtr.name, client,
-                                                        interface, band,
-                                                        networkname],
-                                                value=clients[client])
-                if "channel" in rtr.supported_features and \
-                   len(rtr.channels) != 0:
-                    channgel_gauge.add_metric(labels=[rtr.name, interface,
-                                                      band, networkname],
-                                              value=rtr.channels[index])
-                if "rxtx" in rtr.supported_features and \
-                   len(rtr.interface_rx) > 0 and \
-                   len(rtr.interface_tx) > 0:
-                    tx_gauge.add_metric(labels=[rtr.name, interface],
+        if "thermal" in rtr.supported_features:
+            pass
+        #    yield GaugeMetricFamily('router_cpu_temp',
+        #                            'CPU temperature',
+        #                            value=rtr.dmu_temp)
+        #    yield GaugeMetricFamily(router_name + '_temp_' + interface,
+        #                            'Interface temperature',
+        #                            value=rtr.int_temperatures[index])
+        for index, interface in enumerate(rtr.wireless_interfaces):
+            band = ""
+            networkname = ""
+            channel = None
+            if "channel" in rtr.supported_features and \
+               len(rtr.channels) != 0:
+                channel = rtr.channels[index]
+                band = channel_band(channel)
+            if "ssid" in rtr.supported_features:
+                networkname = rtr.ssids.get(interface, "")
+            if "signal" in rtr.supported_features:
+                self.add_client_metrics(gauges, rtr, index, band,
+                                        networkname)
+            if channel is not None:
+                gauges["channel"].add_metric(labels=[rtr.name, interface,
+                                                     band, networkname],
+                                             value=channel)
+            if "rxtx" in rtr.supported_features and \
+               len(rtr.interface_rx) > index and \
+               rtr.interface_rx[index] is not None:
+                gauges["tx"].add_metric(labels=[rtr.name, interface],
                                         value=rtr.interface_tx[index])
-                    rx_gauge.add_metric(labels=[rtr.name, interface],
+                gauges["rx"].add_metric(labels=[rtr.name, interface],
                                         value=rtr.interface_rx[index])
-        for gauge in gauges:
-            yield gauge
+        for interface, counters in rtr.net_counters.items():
+            for field in NET_METRICS:
+                gauges[field].add_metric(labels=[rtr.name, interface],
+                                         value=getattr(counters, field))
+
+    def add_client_metrics(self, gauges: dict, rtr: router.RouterSnapshot,
+                           index: int, band: str, networkname: str) -> None:
+        """Adds the clients of the router's index-th wireless interface
+        the way client_series says"""
+        interface = rtr.wireless_interfaces[index]
+        ss_dict = None
+        if len(rtr.ss_dicts) > index:
+            ss_dict = rtr.ss_dicts[index]
+        stations = None
+        if len(rtr.station_tables) > index:
+            stations = rtr.station_tables[index]
+        if ss_dict is not None:
+            gauges["clients"].add_metric(
+                labels=[rtr.name, interface, band, networkname],
+                value=len(ss_dict))
+        if self.client_series == "histogram":
+            if ss_dict is not None:
+                self.add_signal_distribution(
+                    gauges, [rtr.name, interface, band, networkname],
+                    ss_dict)
+            return
+        # None if every client gets its series
+        selected = self.selected_clients(ss_dict or {})
+        if ss_dict is not None:
+            for client, ss in ss_dict.items():
+                if ss is not None and (selected is None or
+                                       client in selected):
+                    gauges["signal"].add_metric(
+                        labels=self.client_labels(rtr.name, client,
+                                                  interface, band,
+                                                  networkname),
+                        value=ss)
+        if stations is None:
+            return
+        for client, row in stations.rows.items():
+            if selected is None or client in selected:
+                self.add_station_metrics(
+                    gauges, self.client_labels(rtr.name, client, interface,
+                                               band, networkname),
+                    stations, row)
+
+    def selected_clients(self, ss_dict: dict) -> set | None:
+        """Returns the MACs of the clients which get their own series,
+        None if all of them do"""
+        if self.client_series == "mapped":
+            if self.mapping is None:
+                return set()
+            return {mac for mac in ss_dict if self.mapping.known(mac)}
+        if self.client_series == "top_k" and len(ss_dict) > self.top_k:
+            signals = [(ss, mac) for mac, ss in ss_dict.items()
+                       if ss is not None]
+            return {mac for _, mac in heapq.nlargest(self.top_k, signals)}
+        return None
+
+    def add_signal_distribution(self, gauges: dict, labels: list,
+                                ss_dict: dict) -> None:
+        """Adds the histogram and the min/median/max of the signal
+        strength of an interface's clients"""
+        values = sorted(ss for ss in ss_dict.values() if ss is not None)
+        buckets = [(str(bound), bisect.bisect_right(values, bound))
+                   for bound in SIGNAL_BUCKETS]
+        buckets.append(("+Inf", len(values)))
+        gauges["signal_histogram"].add_metric(labels, buckets, sum(values))
+        if not values:
+            return
+        middle = len(values) // 2
+        median = values[middle]
+        if len(values) % 2 == 0:
+            median = (values[middle - 1] + median) / 2
+        gauges["signal_min"].add_metric(labels=labels, value=values[0])
+        gauges["signal_median"].add_metric(labels=labels, value=median)
+        gauges["signal_max"].add_metric(labels=labels, value=values[-1])
+
+    def client_labels(self, router_name: str, mac: str, interface: str,
+                      band: str, networkname: str) -> tuple:
+        """Returns the labels of a client, with its MAC address
+        replaced by the nickname from mapping.yml"""
+        if self.mapping is None:
+            return (router_name, mac, interface, band, networkname)
+        return self.mapping.labels(router_name, mac, interface, band,
+                                   networkname)
+
+    def add_station_metrics(self, gauges: dict, labels: tuple,
+                            stations: router.StationTable,
+                            row: int) -> None:
+        """Adds the link statistics of a single client"""
+        columns = stations.columns
+        for column, key, factor in STATION_COLUMNS:
+            value = columns[column][row]
+            # NaN if the station dump didn't have the value
+            if value == value:
+                gauges[key].add_metric(labels=labels, value=value * factor)
+
+
+def channel_band(channel: int | None) -> str:
+    """Returns the band of a wireless channel, OFF for 0"""
+    if channel is None:
+        return ""
+    if 0 < channel < 15:
+        return "2.4"
+    if 31 < channel < 178:
+        return "5"
+    if channel == 0:
+        return "OFF"
+    return ""
 
 
 def main() -> None:
     config = load_main_config()
+    if config is None:
+        print("Main config is empty, exitting...")
+        sys.exit(1)
     if config["debug"]:
         logging.basicConfig(level=logging.DEBUG)
         logging.debug("Debug output enabled!")
-    routers = create_router_list(load_routers_config())
-    global MAPPING
-    MAPPING: dict | None = load_mapping_config()
+    defaults = {"batch": config.get("batch", False),
+                "engine": config.get("engine", "fabric"),
+                "command_timeout": config.get("command_timeout", 10.0),
+                "update_timeout": config.get("update_timeout", 30.0),
+                "max_backoff": config.get("max_backoff", 600.0),
+                "interface_ttl": config.get("interface_ttl", 3600.0),
+                "feature_intervals": config.get("feature_intervals") or {},
+                "extra_interfaces": config.get("extra_interfaces") or []}
+    poll_interval = config.get("poll_interval", 0)
+    processes = config.get("processes", 0)
+    # An empty routers config starts without routers until it's reloaded
+    routers_config = load_routers_config() or {}
+    router_poller: poller.Poller | shards.ShardedPoller
+    if processes > 1:
+        # Every worker process owns a part of the routers, this process
+        # only merges their snapshots and serves the metrics
+        router_poller = shards.ShardedPoller(
+            routers_config, defaults, processes,
+            config.get("workers", 0), poll_interval,
+            PROBE_CACHE_LOCATION if config.get("probe_cache", True)
+            else None)
+        router_poller.start()
+    else:
+        probe_cache = None
+        if config.get("probe_cache", True):
+            probe_cache = cache.ProbeCache(PROBE_CACHE_LOCATION)
+        # Routers are initialized in the background, so that the HTTP
+        # endpoint comes up right away
+        router_fleet = fleet.Fleet(routers_config, defaults,
+                                   config.get("workers", 0), probe_cache)
+        router_fleet.start()
+        router_poller = poller.Poller(router_fleet, config.get("workers", 0),
+                                      poll_interval)
+        if poll_interval > 0:
+            router_poller.start()
+    mac_mapping = mapping.MacMapping(MAPPING_CONFIG_LOCATION,
+                                     config.get("mapping_reload_interval",
+                                                5.0))
+    mac_mapping.start()
     collectors = []
-    collectors.append(RouterCollector(routers))
+    routers_reload_interval = config.get("routers_reload_interval", 5.0)
+    if routers_reload_interval > 0:
+        threading.Thread(target=watch_routers_config,
+                         args=(router_poller, routers_reload_interval),
+                         name="routers-config", daemon=True).start()
+    client_series = config.get("client_series", "all")
+    if client_series not in CLIENT_SERIES:
+        print("No such client_series: " + str(client_series)
+              + ", exporting all clients")
+        client_series = "all"
+    router_collector = RouterCollector(router_poller, poll_interval > 0,
+                                       mac_mapping, client_series,
+                                       config.get("client_top_k", 10))
+    # In multi-target mode Prometheus scrapes every router separately
+    # from /probe and /metrics only has the exporter's own metrics
+    if not config.get("multi_target", False):
+        collectors.append(router_collector)
     for collector in collectors:
         REGISTRY.register(collector)
+    if config.get("self_metrics", True):
+        if isinstance(router_poller, shards.ShardedPoller):
+            # The routers' metrics are collected in the worker processes
+            REGISTRY.register(instrumentation.collect_duration)
+            REGISTRY.register(shards.ShardMetrics(router_poller))
+        else:
+            instrumentation.register(REGISTRY)
     if not config["cpython_metrics"]:
         REGISTRY.unregister(PROCESS_COLLECTOR)
         REGISTRY.unregister(PLATFORM_COLLECTOR)
         REGISTRY.unregister(REGISTRY._names_to_collectors[
             'python_gc_objects_collected_total'
             ])
-    start_http_server(config["port"], config["address"])
+    app = server.ExporterApp(REGISTRY, config.get("render_cache_seconds",
+                                                  1.0))
+    app.add_route("/probe", server.ProbeApp(router_collector.probe))
+    if config.get("profiling", False):
+        if isinstance(router_poller, poller.Poller):
+            # Routers updated by worker processes can't be profiled
+            profiling.profiler.known_router = router_poller.configured
+        app.add_route("/debug/profile", profiling.profiler)
+    server.start_server(app, config["port"], config["address"])
     try:
         signal.pause()
     except KeyboardInterrupt:
@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+
+import yaml  # type: ignore
+
+# Memoized label tuples are dropped when there are more than this many,
+# so that MAC randomizing clients can't grow the memo forever
+LABELS_LIMIT = 65536
+
+
+class MacMapping:
+    """Index of MAC address -> nickname read from mapping.yml
+    The file is checked for changes in the background and reloaded
+    without blocking the scrapes, which keep using the previous index
+    until the new one is ready"""
+
+    def __init__(self, path: str, interval: float = 5.0) -> None:
+        self.path = path
+        self.interval = interval
+        # (mtime, size) of the loaded file, None if it doesn't exist
+        self.state: tuple | None = None
+        # Both dicts are replaced as a whole on reload,
+        # so readers don't need a lock
+        # Uppercase MAC -> nickname, None while the file doesn't exist
+        self.index: dict | None = None
+        # (router, MAC as reported, interface, band, networkname)
+        # -> label tuple of the client
+        self.labels_memo: dict = {}
+        self.thread: threading.Thread | None = None
+        self.load()
+
+    def file_state(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self) -> None:
+        """Reads the mapping file and swaps in the new index
+        A broken file keeps the previous index"""
+        state = self.file_state()
+        if state is None:
+            if self.index is not None or self.state is None:
+                print("Mapping config does not exist, mapping disabled...")
+            self.state = None
+            self.index = None
+            self.labels_memo = {}
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as mapping_config:
+                mapping = yaml.safe_load(mapping_config)
+        except (OSError, yaml.YAMLError) as e:
+            print("Unable to load the mapping config: " + str(e))
+            # Not retried until the file changes again
+            self.state = state
+            return
+        if mapping is None:
+            mapping = {}
+        self.index = {str(mac).upper(): str(name)
+                      for mac, name in mapping.items()}
+        self.labels_memo = {}
+        if self.state is not None:
+            print("Mapping config reloaded, "
+                  + str(len(self.index)) + " addresses")
+        self.state = state
+
+    def check(self) -> bool:
+        """Reloads the mapping if the file changed since the last load
+        Returns True if it did"""
+        if self.file_state() == self.state:
+            return False
+        self.load()
+        return True
+
+    def name(self, mac: str) -> str:
+        """Returns the nickname of a MAC address, unknown addresses
+        are uppercased, without a mapping file they are left as they are"""
+        index = self.index
+        if index is None:
+            return mac
+        upper = mac.upper()
+        return index.get(upper, upper)
+
+    def known(self, mac: str) -> bool:
+        """Whether the MAC address has a nickname in the mapping file"""
+        index = self.index
+        return index is not None and mac.upper() in index
+
+    def labels(self, router_name: str, mac: str, interface: str,
+               band: str, networkname: str) -> tuple:
+        """Returns the client label tuple, which is reused
+        as long as the client stays on the same network"""
+        memo = self.labels_memo
+        key = (router_name, mac, interface, band, networkname)
+        labels = memo.get(key)
+        if labels is None:
+            if len(memo) >= LABELS_LIMIT:
+                memo = self.labels_memo = {}
+            labels = (router_name, self.name(mac), interface, band,
+                      networkname)
+            memo[key] = labels
+        return labels
+
+    def start(self) -> None:
+        """Starts watching the file for changes"""
+        if self.interval <= 0:
+            return
+        self.thread = threading.Thread(target=self.run, name="mapping",
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                print("Mapping reload failed: " + repr(e))
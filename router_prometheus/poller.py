@@ -0,0 +1,266 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+from typing import Optional
+
+from . import router
+from . import profiling
+from . import transport
+
+# How long the scheduler sleeps at most before checking the routers again
+SCHEDULER_TICK = 1.0
+# Extra time refresh_all() waits on top of the routers' update_timeout
+DEADLINE_GRACE = 2.0
+
+
+class Poller:
+    """Keeps the latest snapshot of every router
+    Routers are either refreshed in the background, each on its own
+    interval (start()), or all at once on demand (refresh_all())
+    Routers with an asynchronous transport are updated as coroutines
+    in the shared event loop, the others in the executor's threads"""
+
+    def __init__(self, router_fleet, workers: int = 0,
+                 interval: float = 0) -> None:
+        self.fleet = router_fleet
+        self.interval = interval
+        # 0 means one worker per router that isn't updated in the event
+        # loop, so that every router can be updated at the same time,
+        # resized by reconcile()
+        self.workers = workers
+        self.executor_size = self.wanted_executor_size()
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_size,
+                                           thread_name_prefix="poller")
+        # Router name -> RouterSnapshot
+        # The dict is replaced as a whole on every change, so readers
+        # can hold on to it without locking
+        self.snapshots: dict = {}
+        self.lock = threading.Lock()
+        self.in_flight: set = set()
+        # Router name -> Future of its running update
+        self.running: dict = {}
+        self.next_poll: dict = {}
+        self.thread: threading.Thread | None = None
+
+    @property
+    def routers(self) -> list:
+        """Routers that are ready to be polled"""
+        return self.fleet.routers
+
+    def healthy(self, rtr) -> bool:
+        """Whether the router's last update didn't fail"""
+        return rtr.breaker.failures == 0
+
+    def configured(self, name: str) -> bool:
+        """Whether the router is in routers.yml"""
+        return name in self.fleet.routers_config
+
+    def router_interval(self, rtr) -> float:
+        """Returns the polling interval of a router,
+        routers.yml can override the global one"""
+        if rtr.poll_interval:
+            return rtr.poll_interval
+        return self.interval
+
+    def poll(self, rtr) -> bool:
+        """Updates a single router and stores its snapshot
+        Returns True if the update was successful
+        Routers with an open circuit breaker are skipped"""
+        if rtr.breaker.is_open:
+            return False
+        try:
+            with rtr.metrics.updates.time(), \
+                 profiling.profiler.profiled(rtr.name):
+                rtr.update()
+        except Exception as e:
+            self.update_failed(rtr, e)
+            return False
+        return self.update_succeeded(rtr)
+
+    async def poll_async(self, rtr) -> bool:
+        """Coroutine version of poll() for asynchronous routers,
+        see Router.update_async()"""
+        if rtr.breaker.is_open:
+            return False
+        try:
+            with rtr.metrics.updates.time(), \
+                 profiling.profiler.profiled(rtr.name):
+                await rtr.update_async()
+        except Exception as e:
+            self.update_failed(rtr, e)
+            return False
+        return self.update_succeeded(rtr)
+
+    def update_failed(self, rtr, e: Exception) -> None:
+        rtr.rprint("Update failed: " + repr(e))
+        rtr.metrics.failures.inc()
+        backoff = rtr.breaker.failure()
+        if backoff > 0:
+            rtr.rprint("Failed " + str(rtr.breaker.failures)
+                       + " times in a row, skipping it for "
+                       + str(int(backoff)) + " seconds")
+        # The connection may be in an unknown state after a timeout,
+        # the next update() will reconnect
+        try:
+            rtr.transport.close()
+        except Exception:
+            pass
+
+    def update_succeeded(self, rtr) -> bool:
+        """Stores the snapshot of a successful update
+        Returns False if the router was removed in the meantime"""
+        rtr.breaker.success()
+        # Some probe results are only learned during updates
+        rtr.store_probes()
+        snapshot = rtr.snapshot()
+        with self.lock:
+            # The router may have been removed from routers.yml
+            # during the update
+            if not self.fleet.is_current(rtr):
+                return False
+            snapshots = self.snapshots.copy()
+            snapshots[rtr.name] = snapshot
+            self.snapshots = snapshots
+        return True
+
+    def forget(self, names: set) -> None:
+        """Drops the snapshots of routers that were removed or replaced,
+        so that their series disappear right away"""
+        with self.lock:
+            self.snapshots = {name: snapshot
+                              for name, snapshot in self.snapshots.items()
+                              if name not in names}
+        for name in names:
+            self.next_poll.pop(name, None)
+
+    def reconcile(self, routers_config: dict) -> set:
+        """Applies a changed routers.yml, see Fleet.reconcile()"""
+        dropped = self.fleet.reconcile(routers_config)
+        self.forget(dropped)
+        self.resize_executor()
+        return dropped
+
+    def wanted_executor_size(self) -> int:
+        if self.workers < 1:
+            threaded = [name for name, routerconfig
+                        in self.fleet.routers_config.items()
+                        if not router.is_asynchronous(routerconfig)]
+            return max(len(threaded), 1)
+        return self.workers
+
+    def resize_executor(self) -> None:
+        """Replaces the executor when the number of routers changed,
+        see Fleet.resize_executor()"""
+        with self.lock:
+            size = self.wanted_executor_size()
+            if size == self.executor_size:
+                return
+            old_executor = self.executor
+            self.executor_size = size
+            self.executor = ThreadPoolExecutor(max_workers=size,
+                                               thread_name_prefix="poller")
+        old_executor.shutdown(wait=False)
+
+    def submit(self, rtr) -> Optional[Future]:
+        """Schedules an update of a router
+        Returns None if the router is still busy with an earlier update"""
+        with self.lock:
+            if rtr.name in self.in_flight:
+                return None
+            self.in_flight.add(rtr.name)
+            # Submitted with the lock held, so that resize_executor()
+            # can't shut the executor down in between and the update
+            # can't be over before it's tracked
+            if rtr.asynchronous:
+                future = asyncio.run_coroutine_threadsafe(
+                    self.tracked_poll_async(rtr), transport.get_event_loop())
+            else:
+                future = self.executor.submit(self.tracked_poll, rtr)
+            self.running[rtr.name] = future
+        return future
+
+    def tracked_poll(self, rtr) -> bool:
+        try:
+            return self.poll(rtr)
+        finally:
+            self.untrack(rtr)
+
+    async def tracked_poll_async(self, rtr) -> bool:
+        try:
+            return await self.poll_async(rtr)
+        finally:
+            self.untrack(rtr)
+
+    def untrack(self, rtr) -> None:
+        with self.lock:
+            self.in_flight.discard(rtr.name)
+            self.running.pop(rtr.name, None)
+
+    def refresh(self, rtr, timeout: float | None = None) -> bool:
+        """Updates a single router and waits for it, but no longer than
+        timeout (by default the router's update_timeout)
+        Returns True if the router was updated successfully"""
+        future = self.submit(rtr)
+        if future is None:
+            # Still busy with an update that an earlier request gave up
+            # on, its result is just as fresh
+            with self.lock:
+                future = self.running.get(rtr.name)
+            if future is None:
+                return False
+        if timeout is None:
+            timeout = rtr.update_timeout + DEADLINE_GRACE
+        wait([future], timeout=timeout)
+        return future.done() and future.result()
+
+    def target(self, name: str, timeout: float | None = None,
+               refresh: bool = True) -> tuple:
+        """Looks up a single router for /probe and refreshes it
+        unless refresh is False
+        Returns the router, None if it isn't ready yet, and whether
+        it was updated successfully"""
+        rtr = self.fleet.get(name)
+        if rtr is None or not refresh:
+            return rtr, False
+        return rtr, self.refresh(rtr, timeout)
+
+    def refresh_all(self) -> set:
+        """Updates all routers in parallel and waits for them to finish,
+        but no longer than the longest update_timeout
+        Returns the names of routers that were updated successfully"""
+        futures = []
+        timeout = 0.0
+        for rtr in self.routers:
+            future = self.submit(rtr)
+            if future is not None:
+                futures.append((rtr, future))
+                timeout = max(timeout, rtr.update_timeout)
+        wait([future for rtr, future in futures],
+             timeout=timeout + DEADLINE_GRACE)
+        return {rtr.name for rtr, future in futures
+                if future.done() and future.result()}
+
+    def start(self) -> None:
+        """Starts refreshing the routers in the background"""
+        self.thread = threading.Thread(target=self.run, name="scheduler",
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        """Scheduler loop, submits every router that is due for a refresh
+        and isn't being refreshed already"""
+        while True:
+            now = time.monotonic()
+            next_wakeup = now + SCHEDULER_TICK
+            for rtr in self.routers:
+                due = self.next_poll.get(rtr.name, now)
+                if due <= now:
+                    if self.submit(rtr) is None:
+                        # Still busy, checked again on the next tick
+                        continue
+                    due = now + self.router_interval(rtr)
+                    self.next_poll[rtr.name] = due
+                next_wakeup = min(next_wakeup, due)
+            time.sleep(max(next_wakeup - time.monotonic(), 0.01))
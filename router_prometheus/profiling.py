@@ -0,0 +1,296 @@
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import collections
+import tracemalloc
+from typing import Callable
+from urllib.parse import parse_qs
+
+from . import server
+
+FORMATS = ["pstats", "collapsed", "memory"]
+# pstats sort keys that can be requested
+SORT_KEYS = ["cumulative", "tottime", "ncalls", "filename", "name"]
+# Seconds between stack samples of the collapsed format
+SAMPLE_INTERVAL = 0.005
+# Frames kept per allocation by the memory format
+MEMORY_FRAMES = 10
+# Since Python 3.12 only one cProfile.Profile can be enabled at a time,
+# and it records every thread of the process
+SHARED_PROFILE = sys.version_info >= (3, 12)
+
+
+class Session:
+    """A single profiling request, either of the next cycles collection
+    cycles or of the next cycles updates of one router"""
+
+    def __init__(self, cycles: int, router_name: str | None,
+                 output_format: str) -> None:
+        self.cycles = cycles
+        self.router = router_name
+        self.format = output_format
+        self.completed = 0
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.profiles: list = []
+        # The process-wide profile with SHARED_PROFILE, enabled while
+        # at least one thread is inside a profiled block
+        self.shared_profile: cProfile.Profile | None = None
+        self.shared_users = 0
+        # Idents of the threads inside a profiled block
+        self.threads: set = set()
+        # Collapsed stack -> number of samples
+        self.stacks: collections.Counter = collections.Counter()
+        self.memory_start: tracemalloc.Snapshot | None = None
+        self.memory_end: tracemalloc.Snapshot | None = None
+        self.started_tracemalloc = False
+
+    def wants(self, router_name: str | None) -> bool:
+        """Whether a block is profiled, router_name is None
+        for collection cycles"""
+        return self.router is None or router_name == self.router
+
+    def counts(self, router_name: str | None) -> bool:
+        """Whether a finished block counts as a cycle"""
+        if self.router is None:
+            return router_name is None
+        return router_name == self.router
+
+    def start(self) -> None:
+        if self.format == "memory":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(MEMORY_FRAMES)
+                self.started_tracemalloc = True
+            self.memory_start = tracemalloc.take_snapshot()
+        elif self.format == "collapsed":
+            threading.Thread(target=self.sample, name="profile-sampler",
+                             daemon=True).start()
+
+    def stop(self) -> None:
+        self.finished = time.monotonic()
+        if self.shared_profile is not None:
+            # Threads still inside a profiled block disable it again
+            # when they leave, which does nothing
+            with self.lock:
+                self.shared_profile.disable()
+        if self.format == "memory":
+            self.memory_end = tracemalloc.take_snapshot()
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+        self.done.set()
+
+    @contextlib.contextmanager
+    def recording(self):
+        ident = threading.get_ident()
+        with self.lock:
+            nested = ident in self.threads
+            self.threads.add(ident)
+        if nested:
+            yield
+            return
+        profile = self.enable_profile()
+        try:
+            yield
+        finally:
+            self.disable_profile(profile)
+            with self.lock:
+                self.threads.discard(ident)
+
+    def enable_profile(self) -> cProfile.Profile | None:
+        """Starts profiling the calling thread for the pstats format
+        Returns the profile to pass to disable_profile(), None if
+        nothing is profiled, a failure only loses this block's profile"""
+        if self.format != "pstats":
+            return None
+        try:
+            if not SHARED_PROFILE:
+                profile = cProfile.Profile()
+                profile.enable()
+                return profile
+            with self.lock:
+                if self.shared_profile is None:
+                    self.shared_profile = cProfile.Profile()
+                if self.shared_users == 0:
+                    self.shared_profile.enable()
+                    if self.shared_profile not in self.profiles:
+                        self.profiles.append(self.shared_profile)
+                self.shared_users += 1
+                return self.shared_profile
+        except Exception as e:
+            print("Unable to start profiling: " + repr(e))
+            return None
+
+    def disable_profile(self, profile: cProfile.Profile | None) -> None:
+        if profile is None:
+            return
+        try:
+            if profile is not self.shared_profile:
+                profile.disable()
+                with self.lock:
+                    self.profiles.append(profile)
+                return
+            with self.lock:
+                self.shared_users -= 1
+                if self.shared_users == 0:
+                    profile.disable()
+        except Exception as e:
+            print("Unable to stop profiling: " + repr(e))
+
+    def sample(self) -> None:
+        """Samples the stacks of the profiled threads until the session
+        is done, like a sampling profiler would"""
+        while not self.done.wait(SAMPLE_INTERVAL):
+            with self.lock:
+                threads = list(self.threads)
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_filename + ":" + code.co_name)
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def report(self, sort: str, limit: int) -> str:
+        if self.format == "collapsed":
+            # Flamegraph tools take the stacks as they are
+            return "".join(stack + " " + str(count) + "\n"
+                           for stack, count in self.stacks.most_common())
+        end = self.finished if self.finished is not None \
+            else time.monotonic()
+        header = ("Profiled " + str(self.completed) + " of "
+                  + str(self.cycles) + " cycles in "
+                  + "%.1f" % (end - self.started) + " seconds\n\n")
+        if self.format == "memory":
+            return header + self.memory_report(limit)
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return header + "Nothing was profiled\n"
+        output = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats(sort).print_stats(limit)
+        return header + output.getvalue()
+
+    def memory_report(self, limit: int) -> str:
+        """Top allocations during the session and the biggest
+        live allocations at its end"""
+        if self.memory_start is None or self.memory_end is None:
+            return "Memory wasn't traced\n"
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, __file__)]
+        start = self.memory_start.filter_traces(ignored)
+        end = self.memory_end.filter_traces(ignored)
+        lines = ["Allocation growth during the session:"]
+        lines += [str(stat) for stat in
+                  end.compare_to(start, "lineno")[:limit]]
+        lines += ["", "Biggest allocations at the end:"]
+        lines += [str(stat) for stat in end.statistics("lineno")[:limit]]
+        return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """Profiles collection cycles or router updates on request
+    Nothing is measured while no session is running"""
+
+    def __init__(self) -> None:
+        self.session: Session | None = None
+        self.lock = threading.Lock()
+        # known_router(name) tells whether the router's updates
+        # can be profiled, set by main()
+        self.known_router: Callable[[str], bool] | None = None
+
+    def start(self, session: Session) -> bool:
+        """Returns False if another session is running"""
+        with self.lock:
+            if self.session is not None:
+                return False
+            session.start()
+            self.session = session
+            return True
+
+    def finish(self, session: Session) -> None:
+        with self.lock:
+            if self.session is not session:
+                return
+            self.session = None
+        session.stop()
+
+    @contextlib.contextmanager
+    def profiled(self, router_name: str | None = None):
+        """Wraps a collection cycle or, with router_name,
+        a router's update()"""
+        session = self.session
+        if session is None or not session.wants(router_name):
+            yield
+            return
+        with session.recording():
+            yield
+        if not session.counts(router_name):
+            return
+        # Profiling must never fail the profiled update or collection
+        try:
+            with session.lock:
+                session.completed += 1
+                done = session.completed >= session.cycles
+            if done:
+                self.finish(session)
+        except Exception as e:
+            print("Unable to finish profiling: " + repr(e))
+
+    def __call__(self, environ, start_response):
+        """WSGI application of the profiling endpoint
+        /debug/profile?cycles=N&router=NAME&format=FORMAT
+        &sort=KEY&limit=N&timeout=SECONDS"""
+        params = parse_qs(environ.get("QUERY_STRING", ""))
+
+        def param(name, default):
+            return params.get(name, [default])[0]
+
+        try:
+            cycles = int(param("cycles", "1"))
+            limit = int(param("limit", "50"))
+            timeout = float(param("timeout", "300"))
+        except ValueError:
+            return server.text_response(start_response, "400 Bad Request",
+                                        "cycles, limit and timeout "
+                                        "have to be numbers\n")
+        output_format = param("format", "pstats")
+        sort = param("sort", "cumulative")
+        if output_format not in FORMATS or sort not in SORT_KEYS or \
+           cycles < 1:
+            return server.text_response(
+                start_response, "400 Bad Request",
+                "format has to be one of " + ", ".join(FORMATS)
+                + ", sort one of " + ", ".join(SORT_KEYS)
+                + " and cycles at least 1\n")
+        router_name = param("router", None)
+        if router_name is not None and (self.known_router is None
+                                        or not self.known_router(router_name)):
+            # Nothing would ever be profiled until the timeout
+            return server.text_response(start_response, "404 Not Found",
+                                        "Unknown router: " + router_name
+                                        + "\n")
+        session = Session(cycles, router_name, output_format)
+        if not self.start(session):
+            return server.text_response(start_response, "409 Conflict",
+                                        "Another profile is running\n")
+        # Whatever was profiled until the timeout is returned
+        session.done.wait(timeout)
+        self.finish(session)
+        return server.text_response(start_response, "200 OK",
+                                    session.report(sort, limit))
+
+
+# Shared by the collector, the poller and the HTTP endpoint
+profiler = Profiler()
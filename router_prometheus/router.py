@@ -1,9 +1,17 @@
-import fabric  # type: ignore
 # import invoke  # type: ignore
 # import paramiko  # type: ignore
 import json
+import time
+import array
+import uuid
+import zlib
 
+from typing import NamedTuple
+
+from . import breaker
 from . import exceptions
+from . import instrumentation
+from . import transport
 
 features = {
             "int_detect": "Wireless interface detection",
@@ -15,15 +23,295 @@ features = {
             "dmu_temp": "CPU temperature",
             "ssid": "Network name"}
 
+# Features are refreshed this many seconds early rather than waiting
+# for another poll cycle when their interval almost ran out
+FEATURE_SLACK = 1.0
+
+# Errors that point to probe results that don't match the router anymore
+PARSE_ERRORS = (IndexError, KeyError, ValueError, TypeError, AttributeError)
+
+# Prints every network interface followed by 1 if it's wireless, 0 if not
+INTERFACES_COMMAND = ("for i in /sys/class/net/*; do "
+                      "if [ -e \"$i/wireless\" ] || [ -e \"$i/phy80211\" ]; "
+                      "then echo \"${i##*/} 1\"; else echo \"${i##*/} 0\"; "
+                      "fi; done")
+
+
+def parse_interfaces_output(output):
+    """Parses the output of INTERFACES_COMMAND
+    Returns a list of all interfaces and a list of the wireless ones"""
+    all_interfaces = []
+    wireless_interfaces = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        all_interfaces.append(fields[0])
+        if fields[1] == "1":
+            wireless_interfaces.append(fields[0])
+    return all_interfaces, wireless_interfaces
+
+
+def parse_int(value):
+    """Returns value as an int, None if it isn't a number
+    Values are parsed once when they are read from the router,
+    so that rendering doesn't have to convert them again"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def router_engine(routerconfig):
+    """Returns the transport engine of a router's routers.yml entry,
+    its transport section overrides the global engine"""
+    return (routerconfig.get("transport") or {}).get(
+        "engine", routerconfig.get("engine", "fabric"))
+
+
+def is_asynchronous(routerconfig):
+    """Whether a router's routers.yml entry gets an asynchronous
+    transport, whose updates run as coroutines (see update_async())"""
+    return transport.is_asynchronous(router_engine(routerconfig),
+                                     routerconfig.get("transport"))
+
+
+def interfaces_fingerprint(interfaces):
+    """Cheap checksum of an interface list, used to notice
+    that interfaces were added or removed"""
+    return zlib.crc32(" ".join(sorted(interfaces)).encode())
+
+
+class Station(NamedTuple):
+    """Link statistics of a single client from iw's station dump,
+    values missing from the dump are None"""
+    signal: int | None
+    # MBit/s
+    tx_bitrate: float | None
+    rx_bitrate: float | None
+    rx_bytes: int | None
+    tx_bytes: int | None
+    # Milliseconds
+    inactive_time: int | None
+    # Seconds
+    connected_time: int | None
+
+
+# Station dump keys -> index in Station and type of the value
+STATION_FIELDS = {"signal": (0, int),
+                  "tx bitrate": (1, float),
+                  "rx bitrate": (2, float),
+                  "rx bytes": (3, int),
+                  "tx bytes": (4, int),
+                  "inactive time": (5, int),
+                  "connected time": (6, int)}
+
+
+# Value of the fields a station dump doesn't have
+MISSING = float("nan")
+
+
+class StationTable:
+    """Stations of a single interface stored column-wise, one array
+    of floats per Station field, so that thousands of clients don't
+    turn into thousands of tuples and boxed numbers
+    Missing values are NaN"""
+
+    __slots__ = ("rows", "columns")
+
+    def __init__(self) -> None:
+        # MAC -> row number
+        self.rows: dict = {}
+        self.columns = tuple(array.array("d") for _ in Station._fields)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def clear(self) -> None:
+        """Empties the table, keeping its dict and arrays for reuse"""
+        self.rows.clear()
+        for column in self.columns:
+            del column[:]
+
+    def add(self, address: str) -> int:
+        """Adds a row of missing values, returns its number"""
+        row = len(self.columns[0])
+        for column in self.columns:
+            column.append(MISSING)
+        self.rows[address] = row
+        return row
+
+    def station(self, row: int) -> Station:
+        """Returns a row as a Station, with the original types"""
+        values: list = [None] * len(STATION_FIELDS)
+        for index, kind in STATION_FIELDS.values():
+            value = self.columns[index][row]
+            if value == value:
+                values[index] = kind(value)
+        return Station(*values)
+
+    def items(self):
+        """Yields the MAC and Station of every row, like a dict would"""
+        for address, row in self.rows.items():
+            yield address, self.station(row)
+
+    def signals(self) -> dict:
+        """Returns MAC -> signal strength of the stations reporting one"""
+        column = self.columns[0]
+        return {address: int(column[row])
+                for address, row in self.rows.items()
+                if column[row] == column[row]}
+
+
+def parse_station_dump(lines, stations=None):
+    """Reads the stations from the lines of iw dev INT station dump
+    in a single pass
+    Returns a StationTable, stations is cleared and filled if given"""
+    if stations is None:
+        stations = StationTable()
+    else:
+        stations.clear()
+    columns = stations.columns
+    row = None
+    for line in lines:
+        if line.startswith("Station "):
+            row = stations.add(line.split(None, 2)[1])
+            continue
+        if row is None:
+            continue
+        key, _, value = line.partition(":")
+        field = STATION_FIELDS.get(key.strip())
+        if field is None:
+            continue
+        # Only the number at the start of the value is used,
+        # e.g. "-45 [-47, -49] dBm" or "866.7 MBit/s VHT-MCS 9"
+        try:
+            columns[field[0]][row] = float(value.split(None, 1)[0])
+        except (ValueError, IndexError):
+            pass
+    return stations
+
+
+class InterfaceCounters(NamedTuple):
+    """Traffic counters of a network interface from /proc/net/dev"""
+    rx_bytes: int
+    rx_packets: int
+    rx_errors: int
+    rx_drops: int
+    tx_bytes: int
+    tx_packets: int
+    tx_errors: int
+    tx_drops: int
+
+
+# Columns of /proc/net/dev after the interface name that are kept,
+# in the order of InterfaceCounters
+NET_DEV_COLUMNS = (0, 1, 2, 3, 8, 9, 10, 11)
+# Old Broadcom kernels only have 32-bit interface counters
+COUNTER_WRAP = 2 ** 32
+# A counter that went down is only taken as wrapped if it counted less
+# than this since the previous read, anything else is a reset
+# Misreading a wrap as a reset only loses some traffic, misreading
+# a reset as a wrap would add up to this much
+WRAP_MARGIN = COUNTER_WRAP // 8
+
+
+def parse_net_dev(output):
+    """Parses /proc/net/dev
+    Returns a dict of interface -> InterfaceCounters"""
+    counters = {}
+    for line in output.splitlines():
+        # Old kernels don't put a space after the colon: "eth0:1234 ..."
+        interface, colon, values = line.partition(":")
+        if not colon:
+            continue
+        columns = values.split()
+        if len(columns) < 16:
+            continue
+        try:
+            counters[interface.strip()] = InterfaceCounters(
+                *[int(columns[column]) for column in NET_DEV_COLUMNS])
+        except ValueError:
+            continue
+    return counters
+
+
+def unwrap_counters(previous, offsets, current):
+    """Turns 32-bit counters that wrapped around since previous
+    into ever increasing ones by adding COUNTER_WRAP to their offsets
+    A counter that went down without having been close to the wrap point
+    and starting over close to 0 was reset (e.g. by a reboot)
+    and its offset is dropped
+    Returns the new offsets"""
+    if previous is None:
+        return offsets
+    new_offsets = []
+    for old, new, offset in zip(previous, current, offsets):
+        if new < old:
+            if old < COUNTER_WRAP and new + COUNTER_WRAP - old < \
+               WRAP_MARGIN:
+                offset += COUNTER_WRAP
+            else:
+                offset = 0
+        new_offsets.append(offset)
+    return tuple(new_offsets)
+
+
+class RouterSnapshot(NamedTuple):
+    """Immutable view of the data gathered by a single Router.update()
+    The values are shared with the router, which replaces them
+    instead of changing them"""
+    name: str
+    timestamp: float
+    supported_features: tuple
+    wireless_interfaces: tuple
+    # 1, 5 and 15 minute load averages
+    loads: tuple
+    mem_used: float | None
+    # Channel per wireless interface, None if it couldn't be read
+    channels: tuple
+    ssids: dict
+    # MAC -> signal strength in dBm (None if it couldn't be read)
+    # per wireless interface
+    ss_dicts: tuple
+    station_tables: tuple
+    interface_rx: tuple
+    interface_tx: tuple
+    net_counters: dict
+
 
 class Router:
     """Generic router class"""
 
-    def __init__(self, routerconfig):
+    # Every attribute is declared, so that routers don't carry
+    # a __dict__ and a misspelled attribute fails right away
+    __slots__ = ("name", "address", "username", "password", "use_keys",
+                 "transport", "transport_options", "engine", "poll_interval",
+                 "batch", "batch_results", "awaiting", "reprobing",
+                 "command_timeout", "update_timeout", "deadline", "breaker",
+                 "interface_ttl", "interfaces_discovered", "extra_interfaces",
+                 "net_raw",
+                 "net_offsets", "feature_intervals", "refreshed", "due",
+                 "feature", "loads", "mem_used", "channels", "ssids",
+                 "ss_dicts", "station_tables", "interface_rx",
+                 "interface_tx", "net_counters", "int_temperatures",
+                 "dmu_temp", "metrics", "cache", "probes_restored",
+                 "implemented_features", "supported_features",
+                 "wireless_interfaces", "memtotal_index",
+                 "memavailable_index", "memfree_index", "buffers_index",
+                 "cache_index", "proc_taint", "interfaces_fingerprint")
+
+    # Attributes detected by probe(), these are stored in the probe cache
+    probed_attributes = ["supported_features", "wireless_interfaces",
+                         "memtotal_index", "memavailable_index",
+                         "memfree_index", "buffers_index", "cache_index",
+                         "proc_taint", "interfaces_fingerprint"]
+
+    def __init__(self, routerconfig, cache=None):
         self.name = list(routerconfig)[0]
         self.address = routerconfig[self.name]["address"]
         self.username = routerconfig[self.name]["transport"]["username"]
-        self.connection = None
+        self.transport = None
         try:
             self.password = routerconfig[self.name]["transport"]["password"]
         except KeyError:
@@ -36,13 +324,81 @@ class Router:
             self.use_keys = False
         else:
             self.use_keys = routerconfig[self.name]["transport"]["use_keys"]
-        self.connect()
+        # Overrides the global poll_interval from config.yml
+        self.poll_interval = routerconfig[self.name].get("poll_interval")
+        # Run all of update()'s commands as a single script
+        self.batch = routerconfig[self.name].get("batch", False)
+        self.batch_results = {}
+        # Set while update_async() runs the parsers, which may only
+        # use results that were already awaited
+        self.awaiting = False
+        # Whether the running update probes again
+        self.reprobing = False
+        # Global engine from config.yml, overridden by the router's
+        # transport settings in routers.yml
+        self.transport_options = routerconfig[self.name]["transport"]
+        self.engine = router_engine(routerconfig[self.name])
+        # Limits for a single command and for a whole update()
+        self.command_timeout = routerconfig[self.name].get("command_timeout",
+                                                           10.0)
+        self.update_timeout = routerconfig[self.name].get("update_timeout",
+                                                          30.0)
+        self.deadline = None
+        self.breaker = breaker.CircuitBreaker(
+            routerconfig[self.name].get("max_backoff", 600.0))
+        # Seconds before the interface list is discovered again
+        # even if it seems to be unchanged, 0 means never
+        self.interface_ttl = routerconfig[self.name].get("interface_ttl",
+                                                         3600.0)
+        self.interfaces_discovered = time.monotonic()
+        # Wired, bridge or WAN interfaces whose traffic counters
+        # are collected along with the wireless ones
+        self.extra_interfaces = routerconfig[self.name].get(
+            "extra_interfaces") or []
+        # Interface -> last raw InterfaceCounters and the offsets
+        # that undo 32-bit wraparounds
+        self.net_raw = {}
+        self.net_offsets = {}
+        # Feature -> seconds between refreshes, features without one
+        # are refreshed on every update()
+        self.feature_intervals = routerconfig[self.name].get(
+            "feature_intervals") or {}
+        # Feature -> time of its last successful refresh
+        self.refreshed = {}
+        # Features refreshed by the running update()
+        self.due = set()
+        # What the router is doing, commands are timed per feature
+        self.feature = "probe"
+        # Values of the features, the ones that aren't due keep their
+        # last values and share them with the snapshots
+        self.loads = ()
+        self.mem_used = None
+        self.channels = ()
+        self.ssids = {}
+        self.ss_dicts = ()
+        self.station_tables = ()
+        self.interface_rx = ()
+        self.interface_tx = ()
+        self.net_counters = {}
+        self.metrics = instrumentation.RouterMetrics(
+            self.name, routerconfig[self.name].get("backend",
+                                                   type(self).__name__))
+        self.cache = cache
+        self.probes_restored = self.restore_probes()
+        if not self.probes_restored:
+            self.connect()
+            self.probe()
+            self.store_probes()
+
+    def probe(self):
+        """Detects facts about the router that (almost) never change,
+        backends add their own detection to this"""
+        self.supported_features = self.implemented_features.copy()
         # I have a feeling that there should be a condition here
         self.wireless_interfaces = self.get_interfaces()
         if "proc" in self.supported_features:
-            meminfo_output = self.connection.run("cat /proc/meminfo",
-                                                 hide=True)\
-                                                 .stdout.strip().split()
+            meminfo_output = self.run("cat /proc/meminfo").stdout\
+                                                          .strip().split()
             self.memtotal_index = meminfo_output.index("MemTotal:")
             if "MemAvailable:" in meminfo_output:
                 self.memavailable_index = meminfo_output.index("MemAvailable:")
@@ -55,11 +411,47 @@ class Router:
                 self.buffers_index = meminfo_output.index("Buffers:")
                 self.cache_index = meminfo_output.index("Cached:")
 
+    def cache_key(self):
+        return self.name + "@" + self.address
+
+    def restore_probes(self):
+        """Loads probe results from the cache
+        Returns False if there are none for this router and backend"""
+        if self.cache is None:
+            return False
+        entry = self.cache.get(self.cache_key())
+        if entry is None or entry.get("backend") != type(self).__name__:
+            return False
+        for attribute, value in entry["attributes"].items():
+            # Entries written by other versions may have others
+            if attribute in self.probed_attributes:
+                setattr(self, attribute, value)
+        self.rprint("Using cached probe results")
+        return True
+
+    def store_probes(self):
+        if self.cache is None:
+            return
+        attributes = {attribute: getattr(self, attribute)
+                      for attribute in self.probed_attributes
+                      if hasattr(self, attribute)}
+        self.cache.set(self.cache_key(), {"backend": type(self).__name__,
+                                          "attributes": attributes})
+
+    def reprobe(self):
+        """Throws away the (cached) probe results and detects them again"""
+        for attribute in self.probed_attributes:
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        self.probe()
+        self.probes_restored = False
+        self.store_probes()
+
     def __del__(self):
         self.rprint("Destructor got called")
-        if self.connection.is_connected:
+        if self.transport is not None and self.transport.is_connected:
             self.rprint("Closing connection...")
-            self.connection.close()
+            self.transport.close()
 
     def __str__(self):
         return self.name + ": generic backend" + " at " + self.address
@@ -100,81 +492,296 @@ class Router:
                             + features[feature])
         self.rprint("-------------------------------")
 
+    @property
+    def asynchronous(self):
+        """Whether the router is updated with update_async()"""
+        return transport.is_asynchronous(self.engine, self.transport_options)
+
+    def run(self, command, warn=False):
+        """Runs a command on the router
+        Results prefetched by a batch script are used when available
+        During update() the command can't run past the update's deadline"""
+        result = self.batch_results.get(command)
+        if result is not None and (result.ok or warn):
+            return result
+        if self.awaiting:
+            raise exceptions.NotPrefetched(command, warn)
+        timeout = self.time_left(command)
+        channels = self.transport.channels_opened
+        started = time.perf_counter()
+        try:
+            return self.transport.run(command, warn=warn, timeout=timeout)
+        finally:
+            self.metrics.observe_command(
+                self.feature, time.perf_counter() - started,
+                self.transport.channels_opened - channels)
+
+    async def run_async(self, command, warn=False):
+        """Coroutine version of run() for asynchronous transports,
+        without prefetched results"""
+        timeout = self.time_left(command)
+        channels = self.transport.channels_opened
+        started = time.perf_counter()
+        try:
+            return await self.transport.run_async(command, warn=warn,
+                                                  timeout=timeout)
+        finally:
+            self.metrics.observe_command(
+                self.feature, time.perf_counter() - started,
+                self.transport.channels_opened - channels)
+
+    def time_left(self, command):
+        """Returns the timeout of a command, which can't run
+        past the update's deadline"""
+        timeout = self.command_timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise exceptions.DeadlineExceeded(command)
+            timeout = min(timeout, remaining)
+        return timeout
+
+    def batch_commands(self):
+        """Returns the commands update() is going to run,
+        backends add their own commands to these"""
+        commands = []
+        if "proc" in self.due:
+            commands.append("cat /proc/loadavg")
+            commands.append("cat /proc/meminfo")
+        if "rxtx" in self.due:
+            commands.append("cat /proc/net/dev")
+        return commands
+
+    def run_batch(self, commands):
+        """Runs all commands over a single exec channel
+        Returns a dict of command -> CommandResult"""
+        if len(commands) == 0:
+            return {}
+        # The marker has to be unique so that it can't show up
+        # in the output of the commands
+        marker = "@@router_prometheus-" + uuid.uuid4().hex + "@@"
+        output = self.run(transport.batch_script(commands, marker),
+                          warn=True).stdout
+        return transport.parse_batch_output(output, marker, commands)
+
+    async def prefetch_async(self, commands):
+        """Awaits the commands update_async() is going to need,
+        as a single batch script in batch mode
+        Returns a dict of command -> CommandResult"""
+        if not self.batch:
+            return {command: await self.run_async(command, warn=True)
+                    for command in commands}
+        if len(commands) == 0:
+            return {}
+        marker = "@@router_prometheus-" + uuid.uuid4().hex + "@@"
+        result = await self.run_async(transport.batch_script(commands,
+                                                             marker),
+                                      warn=True)
+        return transport.parse_batch_output(result.stdout, marker, commands)
+
+    def start_update(self):
+        """Sets the deadline and the due features of an update
+        Returns its start time"""
+        started = time.monotonic()
+        self.deadline = started + self.update_timeout
+        self.due = self.due_features(started)
+        self.reprobing = False
+        return started
+
     def update(self):
-        if "signal" in self.supported_features:
+        """Refreshes the features that are due
+        Connects first if needed, gives up once update_timeout runs out"""
+        started = self.start_update()
+        try:
+            if self.transport is None or not self.transport.is_connected:
+                self.feature = "connect"
+                self.connect()
+            if self.batch:
+                self.feature = "batch"
+                self.batch_results = self.run_batch(self.batch_commands())
+            self.refresh_features()
+            self.finish_update(started)
+        finally:
+            self.batch_results = {}
+            self.deadline = None
+
+    async def update_async(self):
+        """Coroutine version of update() for asynchronous transports,
+        so that one event loop updates any number of routers without
+        a thread each
+        The commands of batch_commands() are awaited first, then the
+        backend's parsers run on their results like in batch mode.
+        A command the parsers need that wasn't prefetched is awaited
+        and the parsers start over"""
+        started = self.start_update()
+        try:
+            if self.transport is None or not self.transport.is_connected:
+                self.feature = "connect"
+                await self.connect_async()
+            self.feature = "batch"
+            self.batch_results = await self.prefetch_async(
+                self.batch_commands())
+            while True:
+                self.awaiting = True
+                try:
+                    self.refresh_features()
+                    break
+                except exceptions.NotPrefetched as e:
+                    self.awaiting = False
+                    self.batch_results[e.command] = await self.run_async(
+                        e.command, e.warn)
+            self.finish_update(started)
+        finally:
+            self.awaiting = False
+            self.batch_results = {}
+            self.deadline = None
+
+    def refresh_features(self):
+        """Runs the backend's parsers of the due features, probes again
+        if cached probe results don't match the router anymore"""
+        try:
+            self.update_features()
+        except PARSE_ERRORS:
+            # Cached probe results are only checked when they
+            # stop working
+            if not self.probes_restored:
+                raise
+            # update_async() starts over with the results it awaited,
+            # probing again until probe() has all of them
+            if not self.reprobing:
+                self.rprint("Parsing failed with cached probe results,"
+                            + " probing again")
+                self.reprobing = True
+            if not self.awaiting:
+                self.batch_results = {}
+            self.feature = "probe"
+            self.reprobe()
+            self.refresh_all_features()
+            self.update_features()
+
+    def finish_update(self, started):
+        self.freeze_features()
+        # The start time is remembered so that the intervals
+        # don't drift by the length of the update
+        for feature in self.due:
+            self.refreshed[feature] = started
+
+    def due_features(self, now):
+        """Returns the supported features whose refresh interval ran out"""
+        due = set()
+        for feature in self.supported_features:
+            interval = self.feature_intervals.get(feature, 0)
+            refreshed = self.refreshed.get(feature)
+            if refreshed is None or \
+               now - refreshed >= interval - FEATURE_SLACK:
+                due.add(feature)
+        return due
+
+    def refresh_all_features(self):
+        """Makes the running update() refresh every feature,
+        the values of the others are per interface and won't line up
+        with a changed interface list"""
+        self.due = set(self.supported_features)
+
+    def update_features(self):
+        if "signal" in self.due:
             self.ss_dicts = []
-        if "channel" in self.supported_features:
+        if "channel" in self.due:
             self.channels = []
-        if "rxtx" in self.supported_features:
+        if "rxtx" in self.due:
+            self.feature = "rxtx"
+            self.net_counters = self.get_net_counters()
+            # Deprecated per wireless interface byte counters
             self.interface_rx = []
             self.interface_tx = []
-        if "ssid" in self.supported_features:
+        if "ssid" in self.due:
             self.ssids = {}
-        if "proc" in self.supported_features:
-            if self.connection.is_connected:
-                self.loads = self.get_system_load()
-            else:
-                self.connect()
-            if self.connection.is_connected:
-                self.mem_used = self.get_memory_usage()
-            else:
-                self.connect()
-        if "int_temp" in self.supported_features:
+        if "proc" in self.due:
+            self.feature = "proc"
+            self.loads = self.get_system_load()
+            self.mem_used = self.get_memory_usage()
+        if "int_temp" in self.due:
             self.int_temperatures = []
-        if "dmu_temp" in self.supported_features:
-            if self.connection.is_connected:
-                self.dmu_temp = self.get_dmu_temp()
-            else:
-                self.connect()
+        if "dmu_temp" in self.due:
+            self.feature = "dmu_temp"
+            self.dmu_temp = self.get_dmu_temp()
         for interface in self.wireless_interfaces:
-            if "int_temp" in self.supported_features:
-                if self.connection.is_connected:
-                    self.int_temperatures.append(self.get_int_temp(interface))
-                else:
-                    self.connect()
-            if "signal" in self.supported_features:
-                if self.connection.is_connected:
-                    self.ss_dicts.append(self.get_ss_dict(interface))
-                else:
-                    self.connect()
-            if "channel" in self.supported_features:
-                if self.connection.is_connected:
-                    self.channels.append(self.get_channel(interface))
-                else:
-                    self.connect()
-            if "rxtx" in self.supported_features:
-                if self.connection.is_connected:
-                    self.interface_rx.append(self.get_interface_rxtx(interface,
-                                                                     "rx"))
-                else:
-                    self.connect()
-                if self.connection.is_connected:
-                    self.interface_tx.append(self.get_interface_rxtx(interface,
-                                                                     "tx"))
-                else:
-                    self.connect()
-            if "ssid" in self.supported_features:
-                if self.connection.is_connected:
-                    self.ssids[interface] = self.get_ssid(interface)
-
-    def get_interface_rxtx(self, interface, selector):
-        """Takes an interface and selector (either rx or tx)
-        Returns the number of bytes received/transmitted (taken from sysfs)"""
-        return self.connection.run("cat /sys/class/net/"
-                                   + interface
-                                   + "/statistics/"
-                                   + selector
-                                   + "_bytes", hide=True).stdout.strip()
+            if "int_temp" in self.due:
+                self.feature = "int_temp"
+                self.int_temperatures.append(self.get_int_temp(interface))
+            if "signal" in self.due:
+                self.feature = "signal"
+                self.ss_dicts.append(self.get_ss_dict(interface))
+            if "channel" in self.due:
+                self.feature = "channel"
+                self.channels.append(parse_int(self.get_channel(interface)))
+            if "rxtx" in self.due:
+                counters = self.net_counters.get(interface)
+                self.interface_rx.append(
+                    None if counters is None else counters.rx_bytes)
+                self.interface_tx.append(
+                    None if counters is None else counters.tx_bytes)
+            if "ssid" in self.due:
+                self.feature = "ssid"
+                self.ssids[interface] = self.get_ssid(interface)
+
+    def freeze_features(self):
+        """Turns the lists filled by update_features() into tuples,
+        values that weren't refreshed already are"""
+        self.channels = tuple(self.channels)
+        self.ss_dicts = tuple(self.ss_dicts)
+        self.station_tables = tuple(self.station_tables)
+        self.interface_rx = tuple(self.interface_rx)
+        self.interface_tx = tuple(self.interface_tx)
+
+    def snapshot(self):
+        """Returns an immutable view of the data from the last update()
+        Nothing is copied, update() replaces the values it refreshes"""
+        return RouterSnapshot(
+            name=self.name,
+            timestamp=time.time(),
+            supported_features=tuple(self.supported_features),
+            wireless_interfaces=tuple(self.wireless_interfaces),
+            loads=self.loads,
+            mem_used=self.mem_used,
+            channels=self.channels,
+            ssids=self.ssids,
+            ss_dicts=self.ss_dicts,
+            station_tables=self.station_tables,
+            interface_rx=self.interface_rx,
+            interface_tx=self.interface_tx,
+            net_counters=self.net_counters)
+
+    def get_net_counters(self):
+        """Reads the traffic counters of the wireless and extra interfaces
+        from /proc/net/dev in one go
+        Returns a dict of interface -> InterfaceCounters which
+        keep increasing when the router's 32-bit counters wrap around"""
+        raw = parse_net_dev(self.run("cat /proc/net/dev").stdout)
+        counters = {}
+        for interface in self.wireless_interfaces + self.extra_interfaces:
+            current = raw.get(interface)
+            if current is None or interface in counters:
+                continue
+            offsets = unwrap_counters(
+                self.net_raw.get(interface),
+                self.net_offsets.get(interface, (0,) * len(current)),
+                current)
+            self.net_raw[interface] = current
+            self.net_offsets[interface] = offsets
+            counters[interface] = InterfaceCounters(
+                *[value + offset for value, offset in zip(current, offsets)])
+        return counters
 
     def get_system_load(self):
-        """Returns the contents of /proc/loadavg"""
-        return self.connection.run("cat /proc/loadavg",
-                                   hide=True).stdout.strip().split()
+        """Returns the 1, 5 and 15 minute load averages
+        from /proc/loadavg"""
+        fields = self.run("cat /proc/loadavg").stdout.split()
+        return (float(fields[0]), float(fields[1]), float(fields[2]))
 
     def get_memory_usage(self):
         """Returns memory usage in %"""
-        meminfo_output = self.connection.run("cat /proc/meminfo",
-                                             hide=True).stdout.strip().split()
+        meminfo_output = self.run("cat /proc/meminfo").stdout.strip().split()
         mem_total = int(meminfo_output[self.memtotal_index + 1])
         if hasattr(self, "memavailable_index"):
             mem_avail = int(meminfo_output[self.memavailable_index + 1])
@@ -185,33 +792,57 @@ class Router:
         return 100 - (mem_avail / mem_total) * 100
 
     def get_interfaces(self):
-        """Returns a list of wireless interfaces"""
-        interfaces = self.connection.run("ls /sys/class/net",
-                                         hide=True).stdout.strip().split()
-        wireless_interfaces = []
-        for interface in interfaces:
-            evaluated_interface = self.connection.run("ls /sys/class/net/"
-                                                      + interface,
-                                                      hide=True).stdout.strip()
-            if "wireless" in evaluated_interface or \
-               "phy80211" in evaluated_interface:
-                wireless_interfaces.append(interface)
+        """Returns a list of wireless interfaces
+        Remembers when and which interfaces were seen for
+        interfaces_changed()"""
+        all_interfaces, wireless_interfaces = parse_interfaces_output(
+            self.run(INTERFACES_COMMAND).stdout)
+        self.interfaces_fingerprint = interfaces_fingerprint(all_interfaces)
+        self.interfaces_discovered = time.monotonic()
         return wireless_interfaces
 
+    def interfaces_changed(self, all_interfaces):
+        """Returns True if the interface list should be discovered again,
+        either because all_interfaces differs from the last discovery
+        or because interface_ttl ran out"""
+        if getattr(self, "interfaces_fingerprint", None) != \
+           interfaces_fingerprint(all_interfaces):
+            return True
+        return self.interface_ttl > 0 and \
+            time.monotonic() - self.interfaces_discovered > self.interface_ttl
+
     def connect(self):
         """Connects to the router, throws exceptions if it fails somehow"""
-        if self.connection is None:
-            self.connection = fabric.Connection(host=self.address,
-                                                user=self.username,
-                                                connect_kwargs={
-                                                    "password": self.password,
-                                                    "timeout": 30.0})
-            # self.connection.transport.set_keepalive(5)
+        self.open_transport()
+        channels = self.transport.channels_opened
+        try:
+            self.transport.connect()
+        finally:
+            self.metrics.channels.inc(self.transport.channels_opened
+                                      - channels)
+        self.check_connection(self.run("echo", warn=True))
+
+    async def connect_async(self):
+        """Coroutine version of connect()"""
+        self.open_transport()
+        channels = self.transport.channels_opened
+        try:
+            await self.transport.connect_async()
+        finally:
+            self.metrics.channels.inc(self.transport.channels_opened
+                                      - channels)
+        self.check_connection(await self.run_async("echo", warn=True))
+
+    def open_transport(self):
+        if self.transport is None:
+            self.transport = transport.create_transport(
+                self.engine, self.address, self.username, self.password,
+                self.use_keys, self.command_timeout, self.transport_options)
         else:
             self.rprint("Closing and opening connection...")
-            self.connection.close()
-            self.connection.open()
-        result = self.connection.run("echo", hide=True)
+            self.metrics.reconnects.inc()
+
+    def check_connection(self, result):
         if result.ok:
             self.rprint("Connection is OK!")
         else:
@@ -221,13 +852,20 @@ class Router:
 class DdwrtRouter(Router):
     """Inherits from the generic router class and adds DD-WRT-specific stuff"""
 
-    def __init__(self, routerconfig):
+    __slots__ = ("wl_command",)
+
+    probed_attributes = Router.probed_attributes + ["wl_command"]
+
+    def __init__(self, routerconfig, cache=None):
         self.implemented_features = list(features.keys())
         self.supported_features = self.implemented_features.copy()
-        Router.__init__(self, routerconfig)
-        wl_test = self.connection.run("which wl", hide=True, warn=True)
-        wla_test = self.connection.run("which wl_atheros",
-                                       hide=True, warn=True)
+        Router.__init__(self, routerconfig, cache)
+        self.list_features()
+
+    def probe(self):
+        super().probe()
+        wl_test = self.run("which wl", warn=True)
+        wla_test = self.run("which wl_atheros", warn=True)
         if wla_test.exited == 0:
             self.rprint("Detected as an Atheros router, using 'wl_atheros'")
             self.wl_command = "wl_atheros"
@@ -239,31 +877,69 @@ class DdwrtRouter(Router):
             raise exceptions.MissingCommand
         if self.wl_command != "wl":
             self.supported_features.remove("int_temp")
-        if self.connection.run("test -f /proc/dmu/temperature",
-                               warn=True).exited != 0:
+        if self.run("test -f /proc/dmu/temperature",
+                    warn=True).exited != 0:
             self.supported_features.remove("dmu_temp")
-        self.list_features()
 
     def __str__(self):
         return self.name + ": DD-WRT backend" + " at " + self.address
 
+    def wl(self, interface, arguments):
+        """Returns a wl command for the given interface"""
+        return self.wl_command + " -i " + interface + " " + arguments
+
+    def batch_commands(self):
+        commands = super().batch_commands()
+        if "dmu_temp" in self.due:
+            commands.append("cat /proc/dmu/temperature")
+        for interface in self.wireless_interfaces:
+            if "int_temp" in self.due:
+                commands.append(self.wl(interface, "phy_tempsense"))
+            if "signal" in self.due:
+                commands.append(self.rssi_command(interface))
+            if "channel" in self.due:
+                if self.wl_command == "wl":
+                    commands.append(self.wl(interface, "radio"))
+                    commands.append(self.wl(interface, "channel"))
+                else:
+                    commands.append("iw " + interface + " info")
+            if "ssid" in self.due:
+                if self.wl_command == "wl":
+                    commands.append(self.wl(interface, "ssid"))
+                elif "channel" not in self.due:
+                    commands.append("iw " + interface + " info")
+        return commands
+
+    def get_ssid(self, interface):
+        """Returns the interface's network name"""
+        if self.wl_command == "wl":
+            # Current SSID: "name"
+            out = self.run(self.wl(interface, "ssid"), warn=True)
+            if out.exited == 0 and '"' in out.stdout:
+                return out.stdout.split('"', 1)[1].rsplit('"', 1)[0]
+        else:
+            out = self.run("iw " + interface + " info", warn=True)
+            if out.exited == 0:
+                for line in out.stdout.splitlines():
+                    fields = line.split(None, 1)
+                    if len(fields) == 2 and fields[0] == "ssid":
+                        return fields[1]
+        return ""
+
     def get_channel(self, interface):
         """Returns the interface's current channel"""
         if self.wl_command == "wl":
-            radio_on = self.connection.run(self.wl_command +
-                                           " -i " + interface + " radio",
-                                           hide=True).stdout.strip()
+            radio_on = self.run(self.wl(interface, "radio")).stdout.strip()
             if radio_on == "0x0001":
                 return 0
-            lines = self.connection.run(self.wl_command +
-                                        " -i " + interface + " channel",
-                                        hide=True).stdout.strip().splitlines()
+            lines = self.run(self.wl(interface, "channel")).stdout\
+                                                           .strip()\
+                                                           .splitlines()
             for line in lines:
                 if "current" in line:
                     return line.split()[-1]
         elif self.wl_command == "wl_atheros":
-            out = self.connection.run("iw " + interface + " info",
-                                      hide=True, warn=True)
+            out = self.run("iw " + interface + " info", warn=True)
             if out.exited == 0:
                 lines = out.stdout.strip().splitlines()
                 for line in lines:
@@ -274,34 +950,36 @@ class DdwrtRouter(Router):
     def get_ss_dict(self, interface):
         """Overrides the generic dummy function for getting
         the signal strength dictionary"""
-        clients = self.get_clients_list(interface)
+        output = self.run(self.rssi_command(interface), warn=True)
+        return self.parse_rssi_output(output.stdout)
+
+    def rssi_command(self, interface):
+        """Returns a shell loop which prints the MAC and RSSI
+        of every associated client, one client per line
+        This way all clients are read in a single command instead of
+        running wl rssi for every client separately"""
+        return ("for mac in $(" + self.wl(interface, "assoclist")
+                + " 2>/dev/null); do "
+                + "[ \"$mac\" = assoclist ] || echo \"$mac $("
+                + self.wl(interface, "rssi $mac") + " 2>/dev/null)\"; "
+                + "done")
+
+    def parse_rssi_output(self, output):
+        """Takes the output of rssi_command()
+        Returns a dict with MACs and their RSSI values,
+        None if the RSSI couldn't be read"""
         ss_dict = {}
-        for client in clients:
-            new_value = self.get_ss(client, interface)
-            ss_dict.update(new_value)
+        for line in output.strip().splitlines():
+            entry = line.split()
+            if len(entry) > 1:
+                ss_dict[entry[0]] = parse_int(entry[-1])
+            elif len(entry) == 1:
+                ss_dict[entry[0]] = None
         return ss_dict
 
-    def parse_wl_output(self, output):
-        """Only called internally from get_clients_list
-        Takes the raw output of wl assoclist and
-        returns a list of MAC addresses"""
-
-        initial_list = output.stdout.strip().split()
-        client_list = []
-        if output.stdout.strip() != "":
-            for entry in initial_list:
-                if entry != "assoclist":
-                    client_list.append(entry)
-            return client_list
-        else:
-            return []
-
     def get_int_temp(self, interface):
         """Returns the interface's temperature"""
-        out = self.connection.run(self.wl_command
-                                  + " -i " + interface
-                                  + " phy_tempsense",
-                                  hide=True, warn=True)
+        out = self.run(self.wl(interface, "phy_tempsense"), warn=True)
         if out.exited == 0:
             return out.stdout.strip().split()[0]
         else:
@@ -309,84 +987,111 @@ class DdwrtRouter(Router):
 
     def get_dmu_temp(self):
         """Returns the CPU temperature (only available on Broadcom devices)"""
-        out = self.connection.run("cat /proc/dmu/temperature",
-                                  hide=True).stdout.strip()
+        out = self.run("cat /proc/dmu/temperature").stdout.strip()
         if out.isdigit():
             out = str(int(out) / 10)
         return out
 
-    def get_ss(self, mac, interface):
-        """Only called internally from get_ss_dict
-        Takes a MAC address string
-        Returns a dict with a MAC and its RSSI value"""
-
-        output = self.connection.run(self.wl_command +
-                                     " -i " + interface + " rssi " + mac,
-                                     hide=True, warn=True)
-        if output.exited == 0 and len(output.stdout.strip().split()) > 0:
-            return {mac: output.stdout.strip().split()[-1]}
-        else:
-            return {mac: None}
-
-    def get_clients_list(self, interface):
-        """Gets the list of connected clients from the router
-        Uses parse_wl_output to turn the wl output to a list"""
-        response = self.connection.run(self.wl_command +
-                                       " -i " + interface + " assoclist",
-                                       hide=True, warn=True)
-        if response.exited == 0:
-            return self.parse_wl_output(response)
-        else:
-            return []
-
 
 class OwrtRouter(Router):
     """Inherits from the generic router class and
     adds OpenWRT-specific stuff"""
 
-    def __init__(self, routerconfig):
+    __slots__ = ("channel_lines", "ssid_lines", "iw_info",
+                 "station_buffers", "held_station_tables")
+
+    # The iw info line numbers are learned during the first update,
+    # they are cached along with the probe results
+    probed_attributes = Router.probed_attributes + ["channel_lines",
+                                                    "ssid_lines"]
+
+    def __init__(self, routerconfig, cache=None):
         self.implemented_features = ["channel", "rxtx", "proc",
                                      "int_detect", "signal", "ssid"]
         self.supported_features = self.implemented_features.copy()
-        Router.__init__(self, routerconfig)
-        self.initial_interfaces = self.wireless_interfaces.copy()
+        # Interface -> the two StationTables its station dumps
+        # are parsed into by turns
+        self.station_buffers = {}
+        # The tables shared with the latest snapshot
+        self.held_station_tables = ()
+        Router.__init__(self, routerconfig, cache)
         self.list_features()
-        self.device_offset = None
-        self.ss_offset = None
+
+    def probe(self):
+        super().probe()
         self.channel_lines = {}
         self.ssid_lines = {}
 
     def __str__(self):
         return self.name + ": OpenWRT backend" + " at " + self.address
 
-    def update(self):
-        self.check_interfaces()
-        super().update()
+    def batch_commands(self):
+        commands = super().batch_commands()
+        if "int_detect" in self.due:
+            commands.append("ls /sys/class/net")
+        for interface in self.wireless_interfaces:
+            if "channel" in self.due or "ssid" in self.due:
+                commands.append("iw " + interface + " info")
+            if "signal" in self.due:
+                commands.append(self.iw_dump_command(interface))
+        return commands
+
+    def update_features(self):
+        if "int_detect" in self.due:
+            self.feature = "int_detect"
+            self.check_interfaces()
+        if "signal" in self.due:
+            self.station_tables = []
+        super().update_features()
+
+    def freeze_features(self):
+        super().freeze_features()
+        self.held_station_tables = self.station_tables
+
+    def spare_station_table(self, interface):
+        """Returns the one of the interface's two StationTables
+        that the latest snapshot isn't sharing
+        The tables are reused instead of building new arrays every
+        update, a snapshot's tables stay as they are until the update
+        after the next successful one"""
+        tables = self.station_buffers.get(interface)
+        if tables is None:
+            tables = (StationTable(), StationTable())
+            self.station_buffers[interface] = tables
+        if any(held is tables[0] for held in self.held_station_tables):
+            return tables[1]
+        return tables[0]
 
     def check_interfaces(self):
         """A compromise between updating the interface list
         with every update (slow) and going in blind and expecting the
         interface to always be there."""
-        all_interfaces = self.connection.run("ls /sys/class/net",
-                                             hide=True).stdout.strip().split()
-        for interface in self.initial_interfaces:
-            if interface not in all_interfaces or \
-               interface not in self.wireless_interfaces:
-                self.wireless_interfaces = self.get_interfaces()
+        all_interfaces = self.run("ls /sys/class/net").stdout.strip().split()
+        if self.interfaces_changed(all_interfaces):
+            wireless_interfaces = self.get_interfaces()
+            if wireless_interfaces != self.wireless_interfaces:
+                self.wireless_interfaces = wireless_interfaces
                 self.rprint("int_detect: Wireless interfaces: " +
                             str(self.wireless_interfaces))
-                break
+                self.refresh_all_features()
 
     def get_channel(self, interface):
         """Returns the interface's current channel"""
-        self.iw_info = self.connection.run("iw " + interface + " info",
-                                           hide=True).stdout\
-                                                     .strip().splitlines()
+        self.iw_info = self.get_iw_info(interface)
         return self.iw_channel(interface, self.iw_info)
 
     def get_ssid(self, interface):
+        # get_channel() already read iw info if the channel is due too
+        if "channel" not in self.due:
+            self.iw_info = self.get_iw_info(interface)
         return self.iw_ssid(interface, self.iw_info)
 
+    def get_iw_info(self, interface):
+        """Runs iw INT info and returns its lines as a list"""
+        return self.run("iw " + interface + " info").stdout\
+                                                    .strip()\
+                                                    .splitlines()
+
     def iw_channel(self, interface, iw_info):
         """Returns the interface's current channel"""
         if interface not in self.channel_lines:
@@ -434,136 +1139,112 @@ class OwrtRouter(Router):
 
     def get_ss_dict(self, interface):
         """Overrides the generic dummy function for getting
-        the signal strength dictionary"""
-        iwdump = self.get_iw_dump(interface)
-        if self.device_offset is not None:
-            return self.iw_dump_ss_optimized(iwdump)
-        else:
-            self.iw_dump_offsets(iwdump)
-            return self.iw_dump_ss(iwdump)
-        return self.iw_dump_ss(iwdump)
+        the signal strength dictionary
+        The rest of the station dump is kept in station_tables"""
+        stations = parse_station_dump(self.get_iw_dump(interface),
+                                      self.spare_station_table(interface))
+        self.station_tables.append(stations)
+        return stations.signals()
+
+    def iw_dump_command(self, interface):
+        return "iw dev " + interface + " station dump"
 
     def get_iw_dump(self, interface):
         """Runs iw dev INT station dump and returns its lines as a list"""
-        iwdump = self.connection.run("iw dev " + interface + " station dump",
-                                     hide=True).stdout.strip().splitlines()
+        iwdump = self.run(self.iw_dump_command(interface)).stdout\
+                                                          .strip()\
+                                                          .splitlines()
         return iwdump
 
-    def iw_dump_offsets(self, iwdump):
-        """Counts the number of lines between devices
-        and detect signal strength line number"""
-        devices = 0
-        for index, line in enumerate(iwdump):
-            if line.strip().split()[0] == "signal:" and devices == 1:
-                self.ss_offset = index
-            elif line.strip().split()[0] == "Station":
-                if devices == 0:
-                    first_device_line = index
-                elif devices == 1:
-                    self.device_offset = index - first_device_line
-                    self.rprint("Found iwdump device offset, switching "
-                                + "to optimized parser function")
-                    break
-                devices += 1
-
-    def iw_dump_ss(self, iwdump):
-        """Extracts device MAC and its signal strength
-        by iterating through the output of iw dev INT station dump"""
-        ss_dict = {}
-        for index, line in enumerate(iwdump):
-            if line.strip().split()[0] == "Station":
-                address = line.strip().split()[1]
-            if line.strip().split()[0] == "signal:":
-                ss = line.strip().split()[1]
-                ss_dict[address] = ss
-        return ss_dict
-
-    def iw_dump_ss_optimized(self, iwdump):
-        """Extracts device MAC and its signal strength
-        by jumping to speciffic lines of the output
-        of iw dev INT station dump"""
-        ss_dict = {}
-        # Guess the number of devices based on number of lines in  the dump
-        devices = len(iwdump) // self.device_offset
-        # Use the gained parameters for jumping to different lines in the dump
-        for device in range(devices):
-            device_line = device * self.device_offset
-            ss_line = device_line + self.ss_offset
-            address = iwdump[device_line].split()[1]
-            ss = iwdump[ss_line].strip().split()[1]
-            if ss.lstrip('-').isnumeric():
-                ss_dict[address] = ss
-            else:
-                self.rprint("Looks like iwdump has changed a bit")
-                self.rprint("Falling back to unoptimized praser")
-                self.rprint("This will be a slower refresh")
-                self.device_offset = None
-                ss_dict = self.iw_dump_ss(iwdump)
-                break
-        return ss_dict
-
 
 class UbntRouter(Router):
     """Inherits from the generic router class and
     adds Ubiquiti-specific stuff"""
 
-    def __init__(self, routerconfig):
+    __slots__ = ("int_detect_taint",)
+
+    probed_attributes = Router.probed_attributes + ["int_detect_taint"]
+
+    def __init__(self, routerconfig, cache=None):
         self.implemented_features = ["signal", "channel", "rxtx", "proc",
                                      "int_detect"]
         self.supported_features = self.implemented_features.copy()
-        Router.__init__(self, routerconfig)
+        Router.__init__(self, routerconfig, cache)
+        self.list_features()
+
+    def probe(self):
+        super().probe()
         if "wifi0" in self.wireless_interfaces:
             self.rprint("int_detect: Workaround - wifi0 is a dummy" +
                         " interface, removing it from the list")
             self.wireless_interfaces.remove("wifi0")
             self.int_detect_taint = None
-        self.list_features()
 
     def __str__(self):
         return self.name + ": Ubiquiti backend" + " at " + self.address
 
+    def batch_commands(self):
+        commands = super().batch_commands()
+        if "signal" in self.due:
+            commands.append("wstalist")
+        if "channel" in self.due:
+            for interface in self.wireless_interfaces:
+                commands.append("iwgetid -c " + interface)
+        return commands
+
     def get_channel(self, interface):
         """Returns the interface's current channel"""
-        output = self.connection.run("iwgetid -c " + interface,
-                                     hide=True).stdout.strip().splitlines()
+        output = self.run("iwgetid -c " + interface).stdout\
+                                                    .strip().splitlines()
         return output[0].split(":")[1]
 
     def get_ss_dict(self, interface):
         """Overrides the generic dummy function for getting
         the signal strength dictionary"""
-        wstalist = json.loads(self.connection.run("wstalist",
-                              hide=True).stdout)
+        wstalist = json.loads(self.run("wstalist").stdout)
         ss_dict = {}
         for sta in wstalist:
-            ss_dict.update({sta.get("mac"): sta.get("signal")})
+            ss_dict.update({sta.get("mac"): parse_int(sta.get("signal"))})
         return ss_dict
 
 
 class Dslac55uRouter(Router):
 
-    def __init__(self, routerconfig):
+    __slots__ = ("ate_output",)
+
+    def __init__(self, routerconfig, cache=None):
         self.implemented_features = ["signal", "channel", "rxtx", "proc",
                                      "int_detect"]
         self.supported_features = self.implemented_features.copy()
-        Router.__init__(self, routerconfig)
+        Router.__init__(self, routerconfig, cache)
         self.list_features()
 
     def __str__(self):
         return self.name + ": DSL-AC55U backend" + " at " + self.address
 
+    def batch_commands(self):
+        commands = super().batch_commands()
+        if "signal" in self.due or "channel" in self.due:
+            commands.append("ATE show_stainfo")
+        return commands
+
     def get_interfaces(self):
         """Manual override for wireless interfaces of the DSL-AC55U"""
         self.rprint("int_detect: Workaround - Hard-coded" +
                     " wireless interfaces")
-        self.supported_features.remove("int_detect")
+        if "int_detect" in self.supported_features:
+            self.supported_features.remove("int_detect")
         return ["ra0", "rai0"]
 
     def get_ss_dict(self, interface):
-        self.ate_output = self.connection.run("ATE show_stainfo",
-                                              hide=True, warn=True).stdout
+        self.ate_output = self.run("ATE show_stainfo", warn=True).stdout
         return self.ate_output_ss(self.ate_output, interface)
 
     def get_channel(self, interface):
+        # get_ss_dict() already read the station info if the signal
+        # is due too
+        if "signal" not in self.due:
+            self.ate_output = self.run("ATE show_stainfo", warn=True).stdout
         return self.ate_output_channel(self.ate_output, interface)
 
     def ate_output_ss(self, ate_output, interface):
@@ -605,7 +1286,8 @@ class Dslac55uRouter(Router):
                 for line in devlines:
                     if len(line.split()) >= 1:
                         ss_dict.update({
-                            line.split()[0]: line.split()[1].replace("dBm", "")
+                            line.split()[0]: parse_int(
+                                line.split()[1].replace("dBm", ""))
                             })
                     else:
                         print(devlines)
@@ -633,3 +1315,9 @@ class Dslac55uRouter(Router):
             return channel_lines[0].split()[-1]
         elif band == "5g":
             return channel_lines[-1].split()[-1]
+
+
+backends = {"dd-wrt": DdwrtRouter,
+            "openwrt": OwrtRouter,
+            "ubnt": UbntRouter,
+            "dsl-ac55U": Dslac55uRouter}
@@ -0,0 +1,189 @@
+import gzip
+import time
+import hashlib
+import threading
+from urllib.parse import parse_qs
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+from prometheus_client import make_wsgi_app  # type: ignore
+from prometheus_client.exposition import choose_encoder  # type: ignore
+
+# Seconds taken off Prometheus' scrape timeout, so that the response
+# makes it back in time, like the blackbox exporter does
+TIMEOUT_OFFSET = 0.5
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Serves every request in its own thread, so that a slow scrape
+    or a running profile doesn't hold up the other requests"""
+    daemon_threads = True
+
+
+class SilentHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Rendering:
+    """A single serialized collection result, compressed when
+    the first client asks for gzip"""
+
+    def __init__(self, body: bytes) -> None:
+        self.created = time.monotonic()
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.gzipped: bytes | None = None
+        self.lock = threading.Lock()
+
+    def gzip_body(self) -> bytes:
+        if self.gzipped is None:
+            with self.lock:
+                if self.gzipped is None:
+                    self.gzipped = gzip.compress(self.body, compresslevel=6)
+        return self.gzipped
+
+
+class CachedMetricsApp:
+    """Serves the registry's metrics, collected and serialized at most
+    once per max_age seconds in each exposition format
+    Scrapes in between get the same buffers, concurrent scrapes
+    wait for the one that is rendering"""
+
+    def __init__(self, registry, max_age: float) -> None:
+        self.registry = registry
+        self.max_age = max_age
+        # Content type -> latest Rendering
+        self.renderings: dict = {}
+        self.lock = threading.Lock()
+        # Filtered requests (name[]=...) aren't cached
+        self.uncached_app = make_wsgi_app(registry)
+
+    def rendering(self, encoder, content_type: str) -> Rendering:
+        rendering = self.renderings.get(content_type)
+        if rendering is not None and self.is_fresh(rendering):
+            return rendering
+        with self.lock:
+            rendering = self.renderings.get(content_type)
+            if rendering is None or not self.is_fresh(rendering):
+                rendering = Rendering(encoder(self.registry))
+                self.renderings[content_type] = rendering
+            return rendering
+
+    def is_fresh(self, rendering: Rendering) -> bool:
+        return time.monotonic() - rendering.created < self.max_age
+
+    def __call__(self, environ, start_response):
+        if "name[]" in parse_qs(environ.get("QUERY_STRING", "")):
+            return self.uncached_app(environ, start_response)
+        encoder, content_type = choose_encoder(environ.get("HTTP_ACCEPT"))
+        rendering = self.rendering(encoder, content_type)
+        headers = [("Content-Type", content_type),
+                   ("ETag", rendering.etag),
+                   ("Vary", "Accept, Accept-Encoding")]
+        if etag_matches(environ.get("HTTP_IF_NONE_MATCH"), rendering.etag):
+            start_response("304 Not Modified", headers)
+            return [b""]
+        body = rendering.body
+        if "gzip" in environ.get("HTTP_ACCEPT_ENCODING", ""):
+            body = rendering.gzip_body()
+            headers.append(("Content-Encoding", "gzip"))
+        headers.append(("Content-Length", str(len(body))))
+        start_response("200 OK", headers)
+        return [body]
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+class ExporterApp:
+    """WSGI application serving the metrics on every path
+    except the ones added with add_route()
+    With cache_seconds the metrics are rendered at most that often"""
+
+    def __init__(self, registry, cache_seconds: float = 0) -> None:
+        self.metrics_app = make_wsgi_app(registry)
+        if cache_seconds > 0:
+            self.metrics_app = CachedMetricsApp(registry, cache_seconds)
+        # Path -> WSGI application
+        self.routes: dict = {}
+
+    def add_route(self, path: str, app) -> None:
+        self.routes[path] = app
+
+    def __call__(self, environ, start_response):
+        app = self.routes.get(environ.get("PATH_INFO", "/"),
+                              self.metrics_app)
+        return app(environ, start_response)
+
+
+class Families:
+    """Minimal collector holding already collected metric families,
+    for the exposition encoders"""
+
+    def __init__(self, families: list) -> None:
+        self.families = families
+
+    def collect(self) -> list:
+        return self.families
+
+
+class ProbeApp:
+    """WSGI application of the multi-target endpoint /probe?target=NAME
+    probe(target, timeout) returns the metric families of a single
+    target, None if there is no such target"""
+
+    def __init__(self, probe) -> None:
+        self.probe = probe
+
+    def __call__(self, environ, start_response):
+        params = parse_qs(environ.get("QUERY_STRING", ""))
+        target = params.get("target", [""])[0]
+        if not target:
+            return text_response(start_response, "400 Bad Request",
+                                 "target is missing\n")
+        try:
+            timeout = scrape_timeout(environ, params)
+        except ValueError:
+            return text_response(start_response, "400 Bad Request",
+                                 "timeout has to be a number\n")
+        families = self.probe(target, timeout)
+        if families is None:
+            return text_response(start_response, "404 Not Found",
+                                 "Unknown target: " + target + "\n")
+        encoder, content_type = choose_encoder(environ.get("HTTP_ACCEPT"))
+        data = encoder(Families(families))
+        start_response("200 OK", [("Content-Type", content_type),
+                                  ("Content-Length", str(len(data)))])
+        return [data]
+
+
+def scrape_timeout(environ, params: dict) -> float | None:
+    """Returns the timeout parameter or Prometheus' scrape timeout
+    minus TIMEOUT_OFFSET, None if there is neither"""
+    if "timeout" in params:
+        return float(params["timeout"][0])
+    header = environ.get("HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS")
+    if header is None:
+        return None
+    return max(float(header) - TIMEOUT_OFFSET, 0.0)
+
+
+def text_response(start_response, status: str, body: str) -> list:
+    """Sends a plain text response from a WSGI application"""
+    data = body.encode()
+    start_response(status, [("Content-Type", "text/plain; charset=utf-8"),
+                            ("Content-Length", str(len(data)))])
+    return [data]
+
+
+def start_server(app: ExporterApp, port: int, address: str = "") -> None:
+    """Serves app in a background thread"""
+    httpd = make_server(address, port, app, ThreadingWSGIServer,
+                        handler_class=SilentHandler)
+    threading.Thread(target=httpd.serve_forever, name="http",
+                     daemon=True).start()
@@ -0,0 +1,417 @@
+import os
+import time
+import zlib
+import atexit
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from typing import Any, NamedTuple
+
+from . import cache
+from . import fleet
+from . import instrumentation
+from . import poller
+
+# Worker processes are started fresh instead of forked, the exporter
+# already runs threads that a fork would copy in an unknown state
+CONTEXT = multiprocessing.get_context("spawn")
+# Seconds between checks of a worker's snapshots for changes
+PUSH_INTERVAL = 0.5
+# Seconds before a worker process that died is started again
+RESTART_DELAY = 5.0
+# Seconds a worker may take to apply a changed routers config
+RECONCILE_TIMEOUT = 10.0
+
+
+def shard_of(name: str, shards: int) -> int:
+    """Returns the shard a router belongs to, a router stays in the same
+    shard when other routers are added or removed"""
+    return zlib.crc32(name.encode()) % shards
+
+
+def shard_cache_path(path: str, index: int) -> str:
+    """Every worker process keeps its own probe cache file,
+    probe_cache.json becomes probe_cache-0.json, ..."""
+    base, extension = os.path.splitext(path)
+    return base + "-" + str(index) + extension
+
+
+class RouterStatus(NamedTuple):
+    """What the exporter process knows about a router
+    owned by a worker process"""
+    name: str
+    # Failed updates in a row
+    failures: int
+    update_timeout: float
+
+
+class ShardState(NamedTuple):
+    """Changes of a worker's routers since the last ShardState"""
+    # RouterStatus of every ready router
+    routers: tuple
+    # Router name -> new RouterSnapshot
+    snapshots: dict
+    # Routers whose snapshots were dropped
+    removed: tuple
+
+
+def router_status(rtr) -> RouterStatus:
+    return RouterStatus(rtr.name, rtr.breaker.failures, rtr.update_timeout)
+
+
+def run_shard(connection, routers_config: dict, defaults: dict,
+              workers: int, interval: float,
+              cache_path: str | None) -> None:
+    """Entry point of a worker process, which owns the routers
+    of a single shard with their connections"""
+    # Only the exporter process handles CTRL+C, the workers
+    # are stopped along with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    probe_cache = None
+    if cache_path is not None:
+        probe_cache = cache.ProbeCache(cache_path)
+    router_fleet = fleet.Fleet(routers_config, defaults, workers, probe_cache)
+    router_fleet.start()
+    router_poller = poller.Poller(router_fleet, workers, interval)
+    if interval > 0:
+        router_poller.start()
+    ShardWorker(connection, router_poller).run()
+
+
+class ShardWorker:
+    """Worker process side of a shard
+    Answers the exporter's requests and pushes new snapshots
+    as soon as there are any, so that background polling
+    doesn't need a request per scrape"""
+
+    def __init__(self, connection, router_poller: poller.Poller) -> None:
+        self.connection = connection
+        self.poller = router_poller
+        # Sending and computing the changes happen together,
+        # so that the exporter gets the states in order
+        self.lock = threading.Lock()
+        self.sent_snapshots: dict = {}
+        self.sent_routers: tuple = ()
+        self.executor = ThreadPoolExecutor(thread_name_prefix="shard")
+
+    def run(self) -> None:
+        threading.Thread(target=self.push_loop, name="shard-push",
+                         daemon=True).start()
+        while True:
+            try:
+                sequence, request = self.connection.recv()
+            except (EOFError, OSError):
+                # The exporter is gone
+                return
+            self.executor.submit(self.answer, sequence, request)
+
+    def answer(self, sequence: int, request: tuple) -> None:
+        try:
+            result = self.handle(request)
+        except Exception as e:
+            print("Shard request " + request[0] + " failed: " + repr(e))
+            result = None
+        self.send(sequence, result)
+
+    def handle(self, request: tuple):
+        kind = request[0]
+        if kind == "refresh_all":
+            return self.poller.refresh_all()
+        if kind == "target":
+            rtr, updated = self.poller.target(*request[1:])
+            return (None if rtr is None else router_status(rtr), updated)
+        if kind == "reconcile":
+            return self.poller.reconcile(request[1])
+        if kind == "metrics":
+            return [family for metric in instrumentation.router_metrics
+                    for family in metric.collect()]
+        raise ValueError("Unknown shard request: " + kind)
+
+    def state(self) -> ShardState | None:
+        """Returns the changes since the last state, None if there are
+        none, has to be called with the lock held"""
+        snapshots = self.poller.snapshots
+        routers = tuple(router_status(rtr) for rtr in self.poller.routers)
+        if snapshots is self.sent_snapshots and routers == self.sent_routers:
+            return None
+        changed = {name: snapshot for name, snapshot in snapshots.items()
+                   if self.sent_snapshots.get(name) is not snapshot}
+        removed = tuple(name for name in self.sent_snapshots
+                        if name not in snapshots)
+        self.sent_snapshots = snapshots
+        self.sent_routers = routers
+        return ShardState(routers, changed, removed)
+
+    def send(self, sequence: int | None, result=None) -> None:
+        """Sends the result of a request along with the changes
+        it made, sequence is None for changes only"""
+        with self.lock:
+            state = self.state()
+            if state is None and sequence is None:
+                return
+            self.connection.send((sequence, state, result))
+
+    def push_loop(self) -> None:
+        while True:
+            time.sleep(PUSH_INTERVAL)
+            try:
+                self.send(None)
+            except (OSError, ValueError):
+                return
+
+
+class Shard:
+    """Exporter process side of a worker process
+    Requests can be sent from any thread, the replies and pushed
+    changes are read by a thread of their own"""
+
+    def __init__(self, index: int, routers_config: dict, options: tuple,
+                 sharded_poller: "ShardedPoller") -> None:
+        self.index = index
+        # Routers of this shard from routers.yml, a restarted worker
+        # starts with the current ones
+        self.routers_config = routers_config
+        # defaults, workers, interval and the probe cache path
+        self.options = options
+        self.sharded_poller = sharded_poller
+        self.lock = threading.Lock()
+        self.sequence = 0
+        # Sequence number -> Future of the reply
+        self.pending: dict = {}
+        # Set by start()
+        self.connection: Any = None
+        self.process: Any = None
+        # Set when the exporter exits, the worker isn't restarted
+        self.stopping = False
+
+    def start(self) -> None:
+        connection, child_connection = CONTEXT.Pipe()
+        self.process = CONTEXT.Process(
+            target=run_shard, name="shard-" + str(self.index),
+            args=(child_connection, self.routers_config) + self.options,
+            daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.connection = connection
+        threading.Thread(target=self.read, args=(connection,),
+                         name="shard-" + str(self.index) + "-reader",
+                         daemon=True).start()
+
+    def request(self, request: tuple, timeout: float):
+        """Sends a request to the worker and waits for the result
+        Returns None if the worker didn't answer in time"""
+        future: Future = Future()
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            self.pending[sequence] = future
+            try:
+                self.connection.send((sequence, request))
+            except (OSError, ValueError):
+                # The worker died, read() restarts it
+                del self.pending[sequence]
+                return None
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(sequence, None)
+
+    def read(self, connection) -> None:
+        """Applies the worker's changes and hands out the results
+        until the worker exits, then starts it again"""
+        while True:
+            try:
+                sequence, state, result = connection.recv()
+            except (EOFError, OSError):
+                break
+            # Replies of requests that timed out still carry changes
+            if state is not None:
+                self.sharded_poller.apply_state(self.index, state)
+            if sequence is not None:
+                with self.lock:
+                    future = self.pending.pop(sequence, None)
+                if future is not None:
+                    future.set_result(result)
+        connection.close()
+        if self.stopping:
+            return
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending = {}
+        for future in pending:
+            future.set_result(None)
+        self.sharded_poller.drop_shard(self.index)
+        print("Shard " + str(self.index) + " exited, restarting it in "
+              + str(int(RESTART_DELAY)) + " seconds")
+        time.sleep(RESTART_DELAY)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.start()
+
+
+class ShardedPoller:
+    """Stands in for Poller when the routers are split across worker
+    processes, every worker polls its own routers and pushes their
+    snapshots, which are merged here for RouterCollector"""
+
+    def __init__(self, routers_config: dict, defaults: dict, shards: int,
+                 workers: int = 0, interval: float = 0,
+                 cache_path: str | None = None) -> None:
+        self.routers_config = routers_config
+        self.defaults = defaults
+        self.interval = interval
+        self.count = shards
+        self.shards = []
+        for index in range(shards):
+            self.shards.append(Shard(
+                index, self.split(routers_config, index),
+                (defaults, workers, interval,
+                 None if cache_path is None
+                 else shard_cache_path(cache_path, index)),
+                self))
+        # Both are replaced as a whole on every change,
+        # so readers don't need a lock
+        # Router name -> RouterSnapshot
+        self.snapshots: dict = {}
+        # RouterStatus of the ready routers in the order of routers.yml
+        self.routers: list = []
+        # Shard -> its RouterStatus tuple
+        self.statuses: dict = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=shards,
+                                           thread_name_prefix="shards")
+
+    def split(self, routers_config: dict, index: int) -> dict:
+        """Returns the routers of a shard"""
+        return {name: routerconfig
+                for name, routerconfig in routers_config.items()
+                if shard_of(name, self.count) == index}
+
+    def start(self) -> None:
+        """Starts the worker processes"""
+        for shard in self.shards:
+            shard.start()
+        # Registered after multiprocessing's own exit handler,
+        # which stops the workers, so that this one runs first
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        for shard in self.shards:
+            shard.stopping = True
+
+    def apply_state(self, index: int, state: ShardState) -> None:
+        with self.lock:
+            snapshots = self.snapshots.copy()
+            for name in state.removed:
+                snapshots.pop(name, None)
+            snapshots.update(state.snapshots)
+            self.snapshots = snapshots
+            self.statuses[index] = state.routers
+            self.update_routers()
+
+    def drop_shard(self, index: int) -> None:
+        """Forgets the routers of a worker that exited"""
+        with self.lock:
+            names = {status.name for status in self.statuses.pop(index, ())}
+            names.update(self.split(self.routers_config, index))
+            self.snapshots = {name: snapshot
+                              for name, snapshot in self.snapshots.items()
+                              if name not in names}
+            self.update_routers()
+
+    def update_routers(self) -> None:
+        """Rebuilds the list of ready routers,
+        has to be called with the lock held"""
+        ready = {status.name: status for statuses in self.statuses.values()
+                 for status in statuses}
+        self.routers = [ready[name] for name in self.routers_config
+                        if name in ready]
+
+    def healthy(self, status: RouterStatus) -> bool:
+        return status.failures == 0
+
+    def configured(self, name: str) -> bool:
+        return name in self.routers_config
+
+    def update_timeout(self) -> float:
+        """Longest time a worker's update may take"""
+        timeouts = [status.update_timeout for status in self.routers]
+        timeouts.append(self.defaults.get("update_timeout", 30.0))
+        return max(timeouts) + poller.DEADLINE_GRACE
+
+    def request_all(self, request: tuple, timeout: float) -> list:
+        """Sends a request to every worker at the same time
+        Returns their results, None for the ones that didn't answer"""
+        return list(self.executor.map(
+            lambda shard: shard.request(request, timeout), self.shards))
+
+    def refresh_all(self) -> set:
+        """Updates all routers in their worker processes
+        Returns the names of routers that were updated successfully"""
+        updated: set = set()
+        for result in self.request_all(("refresh_all",),
+                                       self.update_timeout()):
+            if result is not None:
+                updated |= result
+        return updated
+
+    def target(self, name: str, timeout: float | None = None,
+               refresh: bool = True) -> tuple:
+        """Poller.target() of the worker that owns the router"""
+        shard = self.shards[shard_of(name, self.count)]
+        wait = self.update_timeout() if timeout is None \
+            else timeout + poller.DEADLINE_GRACE
+        result = shard.request(("target", name, timeout, refresh), wait)
+        if result is None:
+            return None, False
+        return result
+
+    def reconcile(self, routers_config: dict) -> set:
+        """Hands the routers of a changed routers.yml to their workers
+        Returns the names of the routers that were removed or replaced"""
+        with self.lock:
+            self.routers_config = routers_config
+            for shard in self.shards:
+                shard.routers_config = self.split(routers_config,
+                                                  shard.index)
+        dropped: set = set()
+        results = list(self.executor.map(
+            lambda shard: shard.request(("reconcile", shard.routers_config),
+                                        RECONCILE_TIMEOUT), self.shards))
+        for result in results:
+            if result is not None:
+                dropped |= result
+        return dropped
+
+    def router_metrics(self) -> list:
+        """Returns the instrumentation of the routers, collected
+        in every worker and merged into one family per metric"""
+        families: dict = {}
+        for result in self.request_all(("metrics",), RECONCILE_TIMEOUT):
+            for family in result or []:
+                if family.name in families:
+                    families[family.name].samples.extend(family.samples)
+                else:
+                    families[family.name] = family
+        return list(families.values())
+
+
+class ShardMetrics:
+    """Collector of the instrumentation of the worker processes"""
+
+    def __init__(self, sharded_poller: ShardedPoller) -> None:
+        self.sharded_poller = sharded_poller
+
+    def describe(self) -> list:
+        # Registering doesn't wait for the workers
+        return []
+
+    def collect(self) -> list:
+        return self.sharded_poller.router_metrics()
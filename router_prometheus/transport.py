@@ -0,0 +1,509 @@
+import os
+import re
+import abc
+import json
+import time
+import uuid
+import asyncio
+import threading
+
+from typing import NamedTuple
+
+import fabric  # type: ignore
+import invoke  # type: ignore
+
+from . import exceptions
+
+try:
+    import asyncssh  # type: ignore
+except ImportError:
+    asyncssh = None  # type: ignore
+
+
+class CommandResult(NamedTuple):
+    """Output and exit code of a command run on a router"""
+    stdout: str
+    exited: int
+
+    @property
+    def ok(self):
+        return self.exited == 0
+
+
+# Printed after every command of a batch script
+BATCH_PRINTF = "printf '\\n%s %d %d\\n' "
+
+
+def batch_script(commands, marker):
+    """Joins commands into a single shell script
+    Every command's output is followed by a line with the marker,
+    the command's index and its exit code"""
+    lines = []
+    for index, command in enumerate(commands):
+        lines.append(command)
+        lines.append(BATCH_PRINTF + marker + " " + str(index) + " $?")
+    return "\n".join(lines)
+
+
+def parse_batch_output(output, marker, commands):
+    """Splits the output of batch_script() back into per-command results
+    Returns a dict of command -> CommandResult"""
+    results = {}
+    pattern = re.compile("\n" + re.escape(marker) + r" (\d+) (\d+)\n")
+    start = 0
+    for match in pattern.finditer(output):
+        results[commands[int(match.group(1))]] = CommandResult(
+            output[start:match.start()], int(match.group(2)))
+        start = match.end()
+    return results
+
+
+def split_batch_script(script):
+    """Splits a script made by batch_script() back into its commands
+    Returns the commands and the marker, None if script isn't a batch"""
+    lines = script.split("\n")
+    if len(lines) < 2 or len(lines) % 2 != 0 or \
+       not all(line.startswith(BATCH_PRINTF) for line in lines[1::2]):
+        return None
+    return lines[0::2], lines[1][len(BATCH_PRINTF):].split()[0]
+
+
+def batch_output(results, marker):
+    """Returns the output a batch script would print for a list
+    of CommandResults, the opposite of parse_batch_output()"""
+    return "".join(result.stdout + "\n" + marker + " " + str(index) + " "
+                   + str(result.exited) + "\n"
+                   for index, result in enumerate(results))
+
+
+class Transport(abc.ABC):
+    """Generic transport class
+    Transports run commands on a router and return CommandResults,
+    backends only ever talk to the router through one of these
+    Engines implement connect(), run() and close(), asynchronous ones
+    also connect_async() and run_async() (see Router.update_async())"""
+
+    # Whether the engine has connect_async() and run_async()
+    asynchronous = False
+
+    def __init__(self, address, username, password=None, use_keys=False,
+                 connect_timeout=30.0, options=None):
+        self.address = address
+        self.username = username
+        self.password = password
+        self.use_keys = use_keys
+        self.connect_timeout = connect_timeout
+        # The router's transport section from routers.yml
+        self.options = options or {}
+        # SSH channels opened so far, for the exporter's own metrics
+        self.channels_opened = 0
+
+    @property
+    def is_connected(self):
+        return False
+
+    @abc.abstractmethod
+    def connect(self):
+        pass
+
+    @abc.abstractmethod
+    def run(self, command, warn=False, timeout=None):
+        """Runs a command and returns a CommandResult
+        Raises CommandFailed if the command fails and warn isn't set
+        and CommandTimeout if it takes longer than timeout seconds"""
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    def check(self, command, result, warn):
+        if not warn and not result.ok:
+            raise exceptions.CommandFailed(command + " exited with "
+                                           + str(result.exited))
+        return result
+
+
+class FabricTransport(Transport):
+    """Runs every command in its own exec channel using fabric"""
+
+    def __init__(self, address, username, password=None, use_keys=False,
+                 connect_timeout=30.0, options=None):
+        super().__init__(address, username, password, use_keys,
+                         connect_timeout, options)
+        self.connection = None
+
+    @property
+    def is_connected(self):
+        return self.connection is not None and self.connection.is_connected
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = fabric.Connection(host=self.address,
+                                                user=self.username,
+                                                connect_kwargs={
+                                                    "password": self.password,
+                                                    "timeout":
+                                                    self.connect_timeout})
+        else:
+            self.connection.close()
+        self.connection.open()
+        # Without keepalives a lost connection is only noticed
+        # once TCP gives up, which can take a very long time
+        self.connection.transport.set_keepalive(5)
+
+    def run(self, command, warn=False, timeout=None):
+        self.channels_opened += 1
+        try:
+            result = self.connection.run(command, hide=True, warn=True,
+                                         timeout=timeout)
+        except invoke.exceptions.CommandTimedOut:
+            raise exceptions.CommandTimeout(command)
+        return self.check(command,
+                          CommandResult(result.stdout, result.exited), warn)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class SessionTransport(FabricTransport):
+    """Streams all commands into one long-lived shell
+    Avoids opening a new channel (and starting a new shell on the router)
+    for every command. Each command's output is followed by a line with
+    a sentinel marker and the command's exit code"""
+
+    def __init__(self, address, username, password=None, use_keys=False,
+                 connect_timeout=30.0, options=None):
+        super().__init__(address, username, password, use_keys,
+                         connect_timeout, options)
+        self.channel = None
+        self.marker = b""
+        self.counter = 0
+
+    def open_shell(self):
+        """Opens the shell channel, connects first if needed"""
+        if not self.is_connected:
+            FabricTransport.connect(self)
+        self.channel = self.connection.client.get_transport().open_session()
+        self.channels_opened += 1
+        self.channel.exec_command("sh")
+        self.marker = ("@@router_prometheus-" + uuid.uuid4().hex).encode()
+
+    def close_shell(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def connect(self):
+        self.close_shell()
+        super().connect()
+        self.open_shell()
+
+    def run(self, command, warn=False, timeout=None):
+        if self.channel is None or self.channel.closed or \
+           self.channel.exit_status_ready():
+            self.open_shell()
+        # The counter makes sure leftovers of an earlier command
+        # can't be mistaken for this command's end
+        self.counter += 1
+        marker = self.marker + b"-" + str(self.counter).encode()
+        self.channel.sendall(b"{ " + command.encode() + b"\n"
+                             + b"} </dev/null 2>/dev/null\n"
+                             + b"printf '\\n%s %d\\n' " + marker + b" $?\n")
+        pattern = re.compile(b"\n" + re.escape(marker) + rb" (\d+)\n")
+        output = b""
+        match = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        else:
+            self.channel.settimeout(None)
+        while match is None:
+            if timeout is not None:
+                self.channel.settimeout(max(deadline - time.monotonic(), 0))
+            try:
+                data = self.channel.recv(32768)
+            except TimeoutError:
+                # The shell is still busy with the command,
+                # so it can't be used for anything else
+                self.close_shell()
+                raise exceptions.CommandTimeout(command)
+            if not data:
+                self.close_shell()
+                raise exceptions.ConnectionFailed("Shell session closed")
+            # Only the new data and the end of the old data
+            # can contain the marker
+            search_start = max(len(output) - len(marker) - 32, 0)
+            output += data
+            match = pattern.search(output, search_start)
+        return self.check(command,
+                          CommandResult(output[:match.start()]
+                                        .decode(errors="replace"),
+                                        int(match.group(1))), warn)
+
+    def close(self):
+        self.close_shell()
+        super().close()
+
+
+event_loop = None
+event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Returns the event loop shared by all asyncio transports
+    The loop runs in its own thread, which is started on the first call"""
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever,
+                             name="asyncio", daemon=True).start()
+    return event_loop
+
+
+class AsyncsshTransport(Transport):
+    """Runs commands using asyncssh
+    The connections of all routers live in a single event loop,
+    the poller awaits connect_async() and run_async() in it directly
+    connect() and run() hand the coroutines over to the loop and wait
+    for them, for callers in other threads like router initialization"""
+
+    asynchronous = True
+
+    def __init__(self, address, username, password=None, use_keys=False,
+                 connect_timeout=30.0, options=None):
+        if asyncssh is None:
+            raise ImportError("The asyncssh engine requires "
+                              + "the asyncssh package")
+        super().__init__(address, username, password, use_keys,
+                         connect_timeout, options)
+        self.connection = None
+
+    @property
+    def is_connected(self):
+        return self.connection is not None and \
+            not self.connection.is_closed()
+
+    async def connect_async(self):
+        if self.connection is not None:
+            self.connection.close()
+        # Same host:port syntax that fabric accepts
+        host, port = self.address, 22
+        if self.address.count(":") == 1:
+            host, port_string = self.address.split(":")
+            port = int(port_string)
+        self.connection = await asyncssh.connect(
+            host, port=port, username=self.username, password=self.password,
+            known_hosts=None, connect_timeout=self.connect_timeout)
+
+    async def run_async(self, command, warn=False, timeout=None):
+        self.channels_opened += 1
+        try:
+            result = await asyncio.wait_for(self.connection.run(command),
+                                            timeout)
+        except asyncio.TimeoutError:
+            raise exceptions.CommandTimeout(command)
+        exited = result.exit_status
+        if exited is None:
+            exited = -1
+        stdout = result.stdout
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode(errors="replace")
+        return self.check(command, CommandResult(stdout or "", exited), warn)
+
+    def call(self, coroutine):
+        """Runs a coroutine in the shared event loop and waits for it"""
+        loop = get_event_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coroutine.close()
+            raise RuntimeError("Blocking on the event loop's own thread, "
+                               "the coroutine has to be awaited")
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def connect(self):
+        self.call(self.connect_async())
+
+    def run(self, command, warn=False, timeout=None):
+        return self.call(self.run_async(command, warn, timeout))
+
+    def close(self):
+        if self.connection is not None:
+            get_event_loop().call_soon_threadsafe(self.connection.close)
+
+
+# Fixtures are JSON files with a list of recorded responses per command:
+# {"version": 1, "commands": {command: [{"stdout", "exited", "seconds"}]}}
+FIXTURE_VERSION = 1
+# Responses kept per command when recording, replay cycles through them
+RECORD_LIMIT = 20
+
+fixtures: dict = {}
+fixtures_lock = threading.Lock()
+
+
+def load_fixture(path):
+    """Returns the recorded commands from a fixture file,
+    every file is only read once"""
+    with fixtures_lock:
+        if path not in fixtures:
+            with open(path, "r", encoding="utf-8") as fixture_file:
+                content = json.load(fixture_file)
+            if content.get("version") != FIXTURE_VERSION:
+                raise ValueError(path + " has an unsupported fixture version")
+            fixtures[path] = content["commands"]
+        return fixtures[path]
+
+
+def save_fixture(path, commands):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as fixture_file:
+        json.dump({"version": FIXTURE_VERSION, "commands": commands},
+                  fixture_file, indent=1)
+    os.replace(temporary_path, path)
+
+
+class RecordingTransport(Transport):
+    """Wraps another transport and saves every command, its output
+    and how long it took to a fixture file for ReplayTransport
+    Batch scripts are saved as their individual commands"""
+
+    def __init__(self, inner, path):
+        super().__init__(inner.address, inner.username, inner.password,
+                         inner.use_keys, inner.connect_timeout, inner.options)
+        self.inner = inner
+        self.path = path
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    @property
+    def is_connected(self):
+        return self.inner.is_connected
+
+    def connect(self):
+        self.inner.connect()
+        self.channels_opened = self.inner.channels_opened
+
+    def run(self, command, warn=False, timeout=None):
+        start = time.monotonic()
+        try:
+            result = self.inner.run(command, warn=True, timeout=timeout)
+        finally:
+            self.channels_opened = self.inner.channels_opened
+        seconds = time.monotonic() - start
+        batch = split_batch_script(command)
+        if batch is None:
+            self.record({command: result}, seconds)
+        else:
+            commands, marker = batch
+            # Only the time of the whole script is known
+            self.record(parse_batch_output(result.stdout, marker, commands),
+                        seconds / len(commands))
+        return self.check(command, result, warn)
+
+    def record(self, results, seconds):
+        with self.lock:
+            changed = False
+            for command, result in results.items():
+                responses = self.commands.setdefault(command, [])
+                if len(responses) < RECORD_LIMIT:
+                    responses.append({"stdout": result.stdout,
+                                      "exited": result.exited,
+                                      "seconds": round(seconds, 6)})
+                    changed = True
+            if changed:
+                save_fixture(self.path, self.commands)
+
+    def close(self):
+        self.inner.close()
+
+
+class ReplayTransport(Transport):
+    """Serves responses recorded by RecordingTransport,
+    no router is needed
+    Options: fixture - path to the fixture file (defaults to the address)
+             latency - seconds every command takes, by default the
+                       recorded times are used"""
+
+    def __init__(self, address, username, password=None, use_keys=False,
+                 connect_timeout=30.0, options=None):
+        super().__init__(address, username, password, use_keys,
+                         connect_timeout, options)
+        self.fixture = load_fixture(self.options.get("fixture", address))
+        self.latency = self.options.get("latency")
+        self.connected = False
+        self.positions = {}
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    def connect(self):
+        self.connected = True
+
+    def replay(self, command):
+        """Returns the next recorded response for a command
+        and how long it took, unknown commands fail like on a shell"""
+        responses = self.fixture.get(command)
+        if not responses:
+            return CommandResult("", 127), 0.0
+        position = self.positions.get(command, 0)
+        self.positions[command] = (position + 1) % len(responses)
+        response = responses[position]
+        return (CommandResult(response["stdout"], response["exited"]),
+                response["seconds"])
+
+    def run(self, command, warn=False, timeout=None):
+        if not self.connected:
+            raise exceptions.ConnectionFailed("Not connected")
+        batch = split_batch_script(command)
+        if batch is None:
+            result, seconds = self.replay(command)
+        else:
+            commands, marker = batch
+            replayed = [self.replay(batch_command)
+                        for batch_command in commands]
+            result = CommandResult(batch_output([result for result, seconds
+                                                 in replayed], marker), 0)
+            seconds = sum(seconds for result, seconds in replayed)
+        if self.latency is not None:
+            seconds = self.latency
+        if timeout is not None and seconds > timeout:
+            time.sleep(timeout)
+            raise exceptions.CommandTimeout(command)
+        time.sleep(seconds)
+        return self.check(command, result, warn)
+
+    def close(self):
+        self.connected = False
+
+
+engines = {"fabric": FabricTransport,
+           "session": SessionTransport,
+           "asyncssh": AsyncsshTransport,
+           "replay": ReplayTransport}
+
+
+def is_asynchronous(engine, options=None):
+    """Whether create_transport() returns an asynchronous transport
+    for the engine, recording wraps it in a blocking one"""
+    if engine not in engines or options and options.get("record"):
+        return False
+    return engines[engine].asynchronous
+
+
+def create_transport(engine, address, username, password=None,
+                     use_keys=False, connect_timeout=30.0, options=None):
+    """Returns a transport object for the given engine name
+    If options contain record, the transport's commands are saved
+    to that fixture file"""
+    if engine not in engines:
+        raise exceptions.UnknownEngine(engine)
+    transport = engines[engine](address, username, password, use_keys,
+                                connect_timeout, options)
+    if options and options.get("record"):
+        return RecordingTransport(transport, options["record"])
+    return transport